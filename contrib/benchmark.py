@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009-2013 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+
+Micro-benchmarks for the RPC protocol code paths. They run without a Trac
+environment, but need Trac and the plugin to be importable:
+
+    python contrib/benchmark.py [name ...]
+
+Without arguments all benchmarks are run.
+"""
+
+import datetime
+import logging
+import os
+import sys
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tracrpc.util import log_payload
+
+def timed(func, repeat=5):
+    """ Return the best time (in seconds) of `repeat` calls of `func`. """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(title, rows):
+    print title
+    for label, seconds, size in rows:
+        print "  %-40s %10.2f ms %12d bytes logged" % (label,
+                                                        seconds * 1000, size)
+
+class Sink(logging.Handler):
+    """ Formats records like a real handler would, but discards them. """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.size = 0
+
+    def emit(self, record):
+        self.size += len(self.format(record))
+
+def bench_payload_logging(size=20 * 1024 * 1024):
+    """ Logging of a `wiki.putAttachment` request with a large binary. """
+    request = xmlrpclib.dumps(('WikiStart', 'file.bin',
+                               'description', xmlrpclib.Binary('x' * size)),
+                              'wiki.putAttachment')
+    args, method = xmlrpclib.loads(request)
+    log = logging.getLogger('tracrpc.benchmark')
+    log.propagate = False
+    sink = Sink()
+    log.addHandler(sink)
+    rows = []
+    for level in (logging.INFO, logging.DEBUG):
+        log.setLevel(level)
+        name = logging.getLevelName(level)
+
+        def eager():
+            log.debug("RPC(xml) request: %s" % (repr(request)))
+            log.debug("RPC(xml) call by '%s', method '%s' with args: %s" \
+                                    % ('user', method, repr(args)))
+        sink.size = 0
+        rows.append(("eager repr() at %s" % name, timed(eager), sink.size))
+
+        def lazy():
+            log_payload(log, 1024, "RPC(xml) request: %s", request)
+            log_payload(log, 1024, "RPC(xml) call by '%s', method '%s' "
+                        "with args: %s", 'user', method, args)
+        sink.size = 0
+        rows.append(("log_payload() at %s" % name, timed(lazy), sink.size))
+    report("Payload logging, %d MB request (best of 5 runs):"
+           % (len(request) / (1024 * 1024)), rows)
+
+def _ticket(tid):
+    """ A `ticket.get` result for a fairly typical ticket. """
+    when = datetime.datetime(2013, 1, 1, 12, tid % 60, tid % 60)
+    return [tid, when, when, {
+        'summary': u'Crash when saving a page with \xe5 in its name #%d' % tid,
+        'description': u'Steps to reproduce:\r\n * Create a page\r\n' * 8,
+        'status': 'new', 'owner': 'somebody', 'reporter': 'anonymous',
+        'type': 'defect', 'priority': 'major', 'component': 'component1',
+        'milestone': 'milestone1', 'version': '1.0', 'resolution': '',
+        'keywords': 'crash wiki', 'cc': 'user@example.org',
+        'time': when, 'changetime': when, '_ts': str(tid)}]
+
+def _legacy_normalize(obj, json_object_hook):
+    """ Second traversal of decoded objects, as done before the decoders
+    used `object_hook`. """
+    if isinstance(obj, list):
+        return [_legacy_normalize(item, json_object_hook) for item in obj]
+    elif isinstance(obj, dict):
+        if obj.keys() == ['__jsonclass__']:
+            return json_object_hook(obj)
+        return dict([(key, _legacy_normalize(value, json_object_hook))
+                     for key, value in obj.iteritems()])
+    return obj
+
+def bench_json_backends(count=2000):
+    """ Encoding `ticket.get` results and decoding ticket updates. """
+    from tracrpc.json_rpc import JsonCodec, has_speedups, json_backends, \
+                                 json_default, json_object_hook
+    response = {'id': 1, 'error': None,
+                'result': [{'id': i, 'error': None, 'result': _ticket(i)}
+                           for i in range(count)]}
+    rows = []
+    for name, module in sorted(json_backends.items()):
+        label = '%s%s' % (name, has_speedups(module) and ' (C)' or '')
+        codec = JsonCodec(module)
+        def legacy_encode():
+            encoder = module.JSONEncoder(default=json_default)
+            encoded[:] = [''.join(encoder.iterencode(response))]
+        def codec_encode():
+            encoded[:] = [''.join(codec.iterencode(response))]
+        encoded = []
+        rows.append(('%s: iterencode()' % label, timed(legacy_encode),
+                     len(encoded[0])))
+        rows.append(('%s: JsonCodec.iterencode()' % label,
+                     timed(codec_encode), len(encoded[0])))
+        request = codec.encode({'method': 'system.multicall', 'id': 1,
+                'params': [{'method': 'ticket.update', 'id': i,
+                            'params': [i, 'comment', _ticket(i)[3]]}
+                           for i in range(count)]})
+        def legacy_decode():
+            _legacy_normalize(module.loads(request), json_object_hook)
+        rows.append(('%s: loads() + traversal' % label, timed(legacy_decode),
+                     len(request)))
+        rows.append(('%s: JsonCodec.decode()' % label,
+                     timed(lambda: codec.decode(request)), len(request)))
+    print "JSON backends, %d tickets (best of 5 runs):" % count
+    for label, seconds, size in rows:
+        print "  %-40s %10.2f ms %12d bytes" % (label, seconds * 1000, size)
+
+BENCHMARKS = {
+    'json_backends': bench_json_backends,
+    'payload_logging': bench_payload_logging,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -13,9 +13,9 @@ from setuptools import setup, find_packages
 try :
     import crypt
 except ImportError :
-    test_deps = ['twill', 'fcrypt']
+    test_deps = ['twill', 'fcrypt', 'msgpack>=1.0']
 else :
-    test_deps = ['twill']
+    test_deps = ['twill', 'msgpack>=1.0']
 
 setup(
     name='TracXMLRPC',
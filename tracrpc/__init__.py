@@ -11,9 +11,12 @@ import pkg_resources
 pkg_resources.require('Trac >= 0.11')
 
 from tracrpc.api import *
+from tracrpc.metrics import *
 from tracrpc.json_rpc import *
+from tracrpc.msgpack_rpc import *
 from tracrpc.xml_rpc import *
 from tracrpc.web_ui import *
+from tracrpc.notification import *
 from tracrpc.ticket import *
 from tracrpc.wiki import *
 from tracrpc.search import *
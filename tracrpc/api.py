@@ -7,20 +7,62 @@ License: BSD
 """
 
 import inspect
+import Queue
+import thread
+import threading
 import types
 from datetime import datetime
 import xmlrpclib
 
+from trac.config import IntOption
 from trac.core import *
 from trac.perm import IPermissionRequestor
+from trac.util.text import to_unicode
+try:
+    from trac.util.translation import activate, deactivate
+except ImportError:
+    activate = deactivate = None # Trac 0.11
 
-__all__ = ['expose_rpc', 'IRPCProtocol', 'IXMLRPCHandler', 'AbstractRPCHandler',
-            'Method', 'XMLRPCSystem', 'Binary', 'RPCError', 'MethodNotFound', 
-            'ProtocolException', 'ServiceException']
+from tracrpc.util import StringIO, has_transactions
+from tracrpc.metrics import get_query_counter, set_query_counter
+
+__all__ = ['expose_rpc', 'read_only', 'IRPCProtocol', 'IXMLRPCHandler', 'AbstractRPCHandler',
+            'Method', 'MethodInfo', 'XMLRPCSystem', 'Binary', 'SpooledBinary',
+            'RPCError', 'MethodNotFound', 'ProtocolException',
+            'ServiceException']
 
 class Binary(xmlrpclib.Binary):
     """ RPC Binary type. Currently == xmlrpclib.Binary. """
-    pass
+
+    def open(self):
+        """ Return a file-like object to read the data from. """
+        return StringIO(self.data)
+
+    def size(self):
+        """ Return the length of the data. """
+        return len(self.data)
+
+class SpooledBinary(Binary):
+    """ Binary data kept in a file (typically a spooled temporary file) by
+    streaming protocol parsers. The `data` attribute is only read into
+    memory when accessed: use `open()` and `size()` instead. """
+
+    def __init__(self, fileobj, size):
+        self._file = fileobj
+        self._size = size
+
+    def __getattr__(self, name):
+        if name != 'data':
+            raise AttributeError(name)
+        self.data = self.open().read()
+        return self.data
+
+    def open(self):
+        self._file.seek(0)
+        return self._file
+
+    def size(self):
+        return self._size
 
 #----------------------------------------------------------------
 # RPC Exception classes
@@ -55,6 +97,9 @@ RPC_TYPES = {int: 'int', bool: 'boolean', str: 'string', float: 'double',
              datetime: 'DateTime', Binary: 'Binary',
              list: 'array', dict: 'struct', None : 'int'}
 
+# Methods taking a list of calls, counted as multicalls by the protocols
+MULTICALL_METHODS = ('system.multicall', 'system.multicallAtomic')
+
 def expose_rpc(permission, return_type, *arg_types):
     """ Decorator for exposing a method as an RPC call with the given
     signature. """
@@ -66,6 +111,13 @@ def expose_rpc(permission, return_type, *arg_types):
         return func
     return decorator
 
+def read_only(func):
+    """ Decorator for declaring that a method only reads data, so that it
+    may be executed concurrently with other read-only calls as part of
+    `system.multicall`. """
+    func._rpc_read_only = True
+    return func
+
 
 class IRPCProtocol(Interface):
     
@@ -158,6 +210,10 @@ class IXMLRPCHandler(Interface):
         Signatures is a list of XML-RPC introspection signatures for this
         method. Each signature is a tuple consisting of the return type
         followed by argument types.
+
+        Callables declared with the `read_only` decorator may be executed
+        concurrently with other read-only calls as part of
+        `system.multicall`. Any other method is executed on its own.
         """
 
 class AbstractRPCHandler(Component):
@@ -176,24 +232,129 @@ class AbstractRPCHandler(Component):
         return self._rpc_methods
 
 
+class MethodInfo(object):
+    """ Immutable description of an RPC method: name, namespace, permission,
+    signatures and documentation. Instances are computed once and shared
+    process-wide (see `get_method_info()`) by all `Method` objects exposing
+    the same function under the same name. """
+
+    __slots__ = ('name', 'namespace', 'permission', 'rpc_signatures',
+                 'signature_types', 'signature', 'signature_error',
+                 'description', 'namespace_description', 'help', 'read_only')
+
+    def __init__(self, provider, permission, signatures, callable, name=None):
+        namespace = provider.xmlrpc_namespace()
+        name = namespace + '.' + (name or callable.__name__)
+        signatures = tuple([tuple(sig) for sig in signatures])
+        description = inspect.getdoc(callable)
+        try:
+            signature, signature_error = \
+                    _render_signature(callable, name, signatures), None
+        except Exception, e:
+            signature, signature_error = None, '%s: %s' % (
+                                            e.__class__.__name__, e)
+        _set = super(MethodInfo, self).__setattr__
+        _set('name', name)
+        _set('namespace', namespace)
+        _set('permission', permission)
+        _set('rpc_signatures', signatures)
+        _set('signature_types', tuple([','.join([RPC_TYPES.get(x, str(x))
+                                                 for x in sig])
+                                       for sig in signatures]))
+        _set('signature', signature)
+        _set('signature_error', signature_error)
+        _set('description', description)
+        _set('namespace_description', inspect.getdoc(provider))
+        _set('help', '\n'.join((signature or name, '', description or '')))
+        _set('read_only', bool(getattr(callable, '_rpc_read_only', False)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'MethodInfo' object is read-only")
+
+    __delattr__ = __setattr__
+
+def _render_signature(callable, name, signatures):
+    """ Return the signature of a method as text, for instance
+    `'array ticket.query(string qstr="status!=closed")'`. """
+    fullargspec = inspect.getargspec(callable)
+    argspec = fullargspec[0]
+    assert argspec[0:2] == ['self', 'req'] or argspec[0] == 'req', \
+        'Invalid argspec %s for %s' % (argspec, name)
+    while argspec and (argspec[0] in ('self', 'req')):
+        argspec.pop(0)
+    argspec.reverse()
+    defaults = fullargspec[3]
+    if not defaults:
+        defaults = []
+    else:
+        defaults = list(defaults)
+    args = []
+    sig = []
+    for sigcand in signatures:
+        if len(sig) < len(sigcand):
+            sig = sigcand
+    sig = list(sig)
+    for arg in argspec:
+        if defaults:
+            value = defaults.pop()
+            if type(value) is str:
+                if '"' in value:
+                    value = "'%s'" % value
+                else:
+                    value = '"%s"' % value
+            arg += '=%s' % value
+        args.insert(0, RPC_TYPES[sig.pop()] + ' ' + arg)
+    return '%s %s(%s)' % (RPC_TYPES[sig.pop()], name, ', '.join(args))
+
+_method_infos = {}
+_method_infos_lock = threading.Lock()
+
+def get_method_info(provider, permission, signatures, callable, name=None):
+    """ Return the shared `MethodInfo` for a method as described by
+    `IXMLRPCHandler.xmlrpc_methods()`, computing it on first use. """
+    key = (provider.__class__, provider.xmlrpc_namespace(),
+           getattr(callable, 'im_func', callable), name, permission,
+           tuple([tuple(sig) for sig in signatures]))
+    try:
+        return _method_infos[key]
+    except KeyError:
+        pass
+    _method_infos_lock.acquire()
+    try:
+        info = _method_infos.get(key)
+        if info is None:
+            info = _method_infos[key] = MethodInfo(provider, permission,
+                                            signatures, callable, name)
+        return info
+    finally:
+        _method_infos_lock.release()
+
 class Method(object):
     """ Represents an XML-RPC exposed method. """
+
+    __slots__ = ('callable', 'info')
+
     def __init__(self, provider, permission, signatures, callable, name = None):
         """ Accept a signature in the form returned by xmlrpc_methods. """
-        self.permission = permission
         self.callable = callable
-        self.rpc_signatures = signatures
-        self.description = inspect.getdoc(callable)
-        if name is None:
-            self.name = provider.xmlrpc_namespace() + '.' + callable.__name__
-        else:
-            self.name = provider.xmlrpc_namespace() + '.' + name
-        self.namespace = provider.xmlrpc_namespace()
-        self.namespace_description = inspect.getdoc(provider)
+        self.info = get_method_info(provider, permission, signatures,
+                                    callable, name)
+
+    name = property(lambda self: self.info.name)
+    namespace = property(lambda self: self.info.namespace)
+    permission = property(lambda self: self.info.permission)
+    rpc_signatures = property(lambda self: self.info.rpc_signatures)
+    description = property(lambda self: self.info.description)
+    namespace_description = property(
+                            lambda self: self.info.namespace_description)
+
+    def check_permission(self, req):
+        """ Raise `PermissionError` if `req` may not call this method. """
+        if self.info.permission:
+            req.perm.assert_permission(self.info.permission)
 
     def __call__(self, req, args):
-        if self.permission:
-            req.perm.assert_permission(self.permission)
+        self.check_permission(req)
         result = self.callable(req, *args)
         # If result is null, return a zero
         if result is None:
@@ -210,44 +371,15 @@ class Method(object):
 
     def _get_signature(self):
         """ Return the signature of this method. """
-        if hasattr(self, '_signature'):
-            return self._signature
-        fullargspec = inspect.getargspec(self.callable)
-        argspec = fullargspec[0]
-        assert argspec[0:2] == ['self', 'req'] or argspec[0] == 'req', \
-            'Invalid argspec %s for %s' % (argspec, self.name)
-        while argspec and (argspec[0] in ('self', 'req')):
-            argspec.pop(0)
-        argspec.reverse()
-        defaults = fullargspec[3]
-        if not defaults:
-            defaults = []
-        else:
-            defaults = list(defaults)
-        args = []
-        sig = []
-        for sigcand in self.xmlrpc_signatures():
-            if len(sig) < len(sigcand):
-                sig = sigcand
-        sig = list(sig)
-        for arg in argspec:
-            if defaults:
-                value = defaults.pop()
-                if type(value) is str:
-                    if '"' in value:
-                        value = "'%s'" % value
-                    else:
-                        value = '"%s"' % value
-                arg += '=%s' % value
-            args.insert(0, RPC_TYPES[sig.pop()] + ' ' + arg)
-        self._signature = '%s %s(%s)' % (RPC_TYPES[sig.pop()], self.name, ', '.join(args))
-        return self._signature
+        if self.info.signature_error:
+            raise ValueError(self.info.signature_error)
+        return self.info.signature
 
     signature = property(_get_signature)
 
     def xmlrpc_signatures(self):
         """ Signature as an XML-RPC 'signature'. """
-        return self.rpc_signatures
+        return self.info.rpc_signatures
 
 
 class XMLRPCSystem(Component):
@@ -256,9 +388,22 @@ class XMLRPCSystem(Component):
 
     method_handlers = ExtensionPoint(IXMLRPCHandler)
 
+    multicall_workers = IntOption('rpc', 'multicall_workers', 0,
+        """Maximum number of threads used to execute read-only calls of a
+        `system.multicall` concurrently, each with its own database
+        connection. Calls that may modify data are always executed one at a
+        time and in order. `0` or `1` executes all calls sequentially.""")
+
+    log_payload_size = IntOption('rpc', 'log_payload_size', 1024,
+        """Maximum number of characters of request and response payloads
+        written to the log at DEBUG level. Longer payloads are abbreviated.
+        `0` disables logging of payloads.""")
+
     def __init__(self):
         self.env.systeminfo.append(('RPC',
                         __import__('tracrpc', ['__version__']).__version__))
+        self._method_index = None
+        self._method_index_lock = threading.Lock()
 
     # IPermissionRequestor methods
     def get_permission_actions(self):
@@ -270,6 +415,8 @@ class XMLRPCSystem(Component):
 
     def xmlrpc_methods(self):
         yield ('XML_RPC', ((list, list),), self.multicall)
+        if has_transactions(self.env):
+            yield ('XML_RPC', ((list, list),), self.multicallAtomic)
         yield ('XML_RPC', ((list,),), self.listMethods)
         yield ('XML_RPC', ((str, str),), self.methodHelp)
         yield ('XML_RPC', ((list, str),), self.methodSignature)
@@ -277,21 +424,47 @@ class XMLRPCSystem(Component):
 
     def get_method(self, method):
         """ Get an RPC signature by full name. """ 
-        for provider in self.method_handlers:
+        try:
+            return self._get_method_index()[1][method]
+        except KeyError:
+            raise MethodNotFound('RPC method "%s" not found' % method)
+
+    def _get_method_index(self):
+        """ Return a `(methods, methods_by_name)` tuple for all enabled
+        method providers. The index is built on first use, and
+        rebuilt whenever the set of enabled providers changes (components
+        enabled or disabled). """
+        providers = tuple(self.method_handlers)
+        index = self._method_index
+        if index is None or index[0] != providers:
+            self._method_index_lock.acquire()
+            try:
+                index = self._method_index
+                if index is None or index[0] != providers:
+                    index = self._build_method_index(providers)
+                    self._method_index = index
+            finally:
+                self._method_index_lock.release()
+        return index[1:]
+
+    def _build_method_index(self, providers):
+        methods = []
+        by_name = {}
+        for provider in providers:
             for candidate in provider.xmlrpc_methods():
-                #self.env.log.debug(candidate)
                 p = Method(provider, *candidate)
-                if p.name == method:
-                    return p
-        raise MethodNotFound('RPC method "%s" not found' % method)
-        
+                methods.append(p)
+                # First provider to claim a name wins (as with linear lookup)
+                by_name.setdefault(p.name, p)
+        self.log.debug("RPC method index built: %d methods from %d "
+                       "providers", len(methods), len(providers))
+        return (providers, methods, by_name)
+
     # Exported methods
     def all_methods(self, req):
         """ List all methods exposed via RPC. Returns a list of Method objects. """
-        for provider in self.method_handlers:
-            for candidate in provider.xmlrpc_methods():
-                # Expand all fields of method description
-                yield Method(provider, *candidate)
+        for method in self._get_method_index()[0]:
+            yield method
 
     def multicall(self, req, signatures):
         """ Takes an array of RPC calls encoded as structs of the form (in
@@ -299,26 +472,120 @@ class XMLRPCSystem(Component):
         For JSON-RPC multicall, signatures is an array of regular method call
         structs, and result is an array of return structures.
         """
+        workers = self.multicall_workers
+        if workers <= 1:
+            for signature in signatures:
+                yield self._multicall_one(req, signature)
+            return
+        # Run consecutive read-only calls concurrently, and wait for them
+        # to complete before executing a call that may modify data.
+        batch = []
         for signature in signatures:
+            if self._is_read_only(signature):
+                batch.append(signature)
+                continue
+            for result in self._multicall_parallel(req, batch, workers):
+                yield result
+            batch = []
+            yield self._multicall_one(req, signature)
+        for result in self._multicall_parallel(req, batch, workers):
+            yield result
+
+    def multicallAtomic(self, req, signatures):
+        """ Same input and result as `system.multicall`, but all calls are
+        executed in a single database transaction: either every call succeeds
+        and all changes are committed at once, or the first failing call
+        aborts the request and no changes are saved. Notifications are only
+        sent after the changes have been committed. Attachment files are not
+        covered by the transaction. Requires Trac 0.12 or higher. """
+        from tracrpc.util import run_atomic
+        def do_calls(db):
+            results = []
+            for idx, signature in enumerate(signatures):
+                method_name = signature.get('methodName')
+                try:
+                    results.append(self.get_method(method_name)(req,
+                                                    signature['params']))
+                except Exception, e:
+                    self.log.info("RPC system.multicallAtomic: call %d "
+                                  "(%s) failed, rolling back: %s", idx,
+                                  method_name, e)
+                    raise RPCError("Call %d (%s) failed, no changes saved: "
+                                   "%s" % (idx, method_name, to_unicode(e)))
+            return results
+        return run_atomic(self.env, req, do_calls)
+
+    def _multicall_one(self, req, signature):
+        try:
+            return self.get_method(signature['methodName'])(req,
+                                                        signature['params'])
+        except Exception, e:
+            return e
+
+    def _is_read_only(self, signature):
+        try:
+            return self.get_method(signature['methodName']).info.read_only
+        except Exception:
+            return True # Fails anyway, no harm in running it concurrently
+
+    def _multicall_parallel(self, req, signatures, workers):
+        """ Execute calls using at most `workers` threads, and return the
+        results in the same order as the calls. """
+        if len(signatures) < 2:
+            return [self._multicall_one(req, sig) for sig in signatures]
+        # Request attributes are computed lazily on first access; resolve
+        # them now so that the workers only read the shared request.
+        for name in ('authname', 'perm', 'session', 'locale', 'tz'):
+            getattr(req, name, None)
+        locale = getattr(req, 'locale', None)
+        # Queries of the workers count for the call
+        counter = get_query_counter()
+        results = [None] * len(signatures)
+        pending = Queue.Queue()
+        for idx, signature in enumerate(signatures):
+            pending.put((idx, signature))
+        def worker():
+            # Translations are activated per thread
+            if activate is not None and locale is not None:
+                activate(locale)
+            set_query_counter(counter)
             try:
-                yield self.get_method(signature['methodName'])(req, signature['params'])
-            except Exception, e:
-                yield e
-
+                while True:
+                    try:
+                        idx, signature = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    results[idx] = self._multicall_one(req, signature)
+            finally:
+                set_query_counter(None)
+                if deactivate is not None and locale is not None:
+                    deactivate()
+                # Release database connection(s) held by this thread
+                self.env.shutdown(thread.get_ident())
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(workers, len(signatures)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    @read_only
     def listMethods(self, req):
         """ This method returns a list of strings, one for each (non-system)
         method supported by the RPC server. """
         for method in self.all_methods(req):
             yield method.name
 
+    @read_only
     def methodHelp(self, req, method):
         """ This method takes one parameter, the name of a method implemented
         by the RPC server. It returns a documentation string describing the
         use of that method. If no such string is available, an empty string is
         returned. The documentation string may contain HTML markup. """
-        p = self.get_method(method)
-        return '\n'.join((p.signature, '', p.description))
+        return self.get_method(method).info.help
 
+    @read_only
     def methodSignature(self, req, method):
         """ This method takes one parameter, the name of a method implemented
         by the RPC server.
@@ -326,9 +593,9 @@ class XMLRPCSystem(Component):
         It returns an array of possible signatures for this method. A signature
         is an array of types. The first of these types is the return type of
         the method, the rest are parameters. """
-        p = self.get_method(method)
-        return [','.join([RPC_TYPES[x] for x in sig]) for sig in p.xmlrpc_signatures()]
+        return list(self.get_method(method).info.signature_types)
 
+    @read_only
     def getAPIVersion(self, req):
         """ Returns a list with three elements. First element is the
         epoch (0=Trac 0.10, 1=Trac 0.11 or higher). Second element is the major
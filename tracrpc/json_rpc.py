@@ -16,16 +16,19 @@ except ImportError:
     babel = None
 import genshi
 
+from trac.config import Option
 from trac.core import *
 from trac.perm import PermissionError
 from trac.resource import ResourceNotFound
 from trac.util.datefmt import utc
 from trac.util.text import to_unicode
-from trac.web.api import RequestDone
+from trac.web.api import HTTPRequestEntityTooLarge, RequestDone
 
 from tracrpc.api import IRPCProtocol, XMLRPCSystem, Binary, \
-        RPCError, MethodNotFound, ProtocolException
-from tracrpc.util import exception_to_unicode, empty, prepare_docs
+        RPCError, MethodNotFound, ProtocolException, MULTICALL_METHODS
+from tracrpc.metrics import RPCMetrics
+from tracrpc.util import RequestBody, ResponseStream, \
+                         exception_to_unicode, empty, log_payload, prepare_docs
 
 __all__ = ['JsonRpcProtocol']
 
@@ -41,77 +44,157 @@ except (ImportError, AttributeError):
         json = None
         __all__ = []
 
+# JSON libraries that can be selected with `[rpc] json_backend`
+json_backends = {}
+if json:
+    json_backends[json.__name__] = json
+    try:
+        import simplejson
+        json_backends['simplejson'] = simplejson
+    except ImportError:
+        pass
+
+def has_speedups(module):
+    """ Return `True` if the JSON library uses its C extension for
+    encoding. """
+    encoder = getattr(module, 'encoder', None)
+    return getattr(encoder, 'c_make_encoder', None) is not None
+
+_datetime_re = re.compile(
+            '^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,}))?')
+
+def json_default(obj):
+    """ Encode the additional types supported by JSON-RPC:
+    1. datetime.datetime => {'__jsonclass__': ["datetime", "<rfc3339str>"]}
+    2. tracrpc.api.Binary => {'__jsonclass__': ["binary", "<base64str>"]}
+    3. empty => ''
+    4. genshi.builder.Fragment|genshi.core.Markup => unicode
+    5. babel.support.LazyProxy => unicode
+    """
+    if isinstance(obj, datetime.datetime):
+        # http://www.ietf.org/rfc/rfc3339.txt
+        return {'__jsonclass__': ["datetime",
+                        obj.strftime('%Y-%m-%dT%H:%M:%S')]}
+    elif isinstance(obj, Binary):
+        return {'__jsonclass__': ["binary",
+                        obj.data.encode("base64")]}
+    elif obj is empty:
+        return ''
+    elif isinstance(obj, (genshi.builder.Fragment,
+                          genshi.core.Markup)):
+        return unicode(obj)
+    elif babel and isinstance(obj, babel.support.LazyProxy):
+        return unicode(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+def json_object_hook(obj):
+    """ Decode the additional types supported by JSON-RPC, as each object
+    is parsed:
+    1. {'__jsonclass__': ["datetime", "<rfc3339str>"]} => datetime.datetime
+    2. {'__jsonclass__': ["binary", "<base64str>"]} => tracrpc.api.Binary
+    """
+    if len(obj) != 1 or '__jsonclass__' not in obj:
+        return obj
+    kind, val = obj['__jsonclass__']
+    if kind == 'datetime':
+        dt = _datetime_re.match(val)
+        if not dt:
+            raise Exception("Invalid datetime string (%s)" % val)
+        dt = tuple([int(i) for i in dt.groups() if i])
+        kw_args = {'tzinfo': utc}
+        return datetime.datetime(*dt, **kw_args)
+    elif kind == 'binary':
+        try:
+            bin = val.decode("base64")
+            return Binary(bin)
+        except:
+            raise Exception("Invalid base64 string")
+    else:
+        raise Exception("Unknown __jsonclass__: %s" % kind)
+
+class JsonCodec(object):
+    """ Encodes and decodes JSON-RPC messages with the given JSON library,
+    handling the additional types through the `default` and `object_hook`
+    hooks of the library. """
+
+    def __init__(self, module):
+        self.module = module
+        self.name = module.__name__
+        self._encoder = module.JSONEncoder(default=json_default)
+        self._decoder = module.JSONDecoder(object_hook=json_object_hook)
+
+    def decode(self, text):
+        return self._decoder.decode(text)
+
+    def load(self, fileobj):
+        return self.decode(fileobj.read())
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def iterencode(self, obj, depth=3):
+        """ Encode `obj` in pieces: the items of containers down to `depth`
+        levels (the response envelope, the result and its items) are
+        encoded one at a time, so that the one-shot encoder of the library
+        is used (which is the C-accelerated one, when available), while
+        large results can still be written as they are encoded. """
+        if depth and isinstance(obj, (list, tuple)) and obj:
+            yield '['
+            first = True
+            for item in obj:
+                if not first:
+                    yield ', '
+                first = False
+                for chunk in self.iterencode(item, depth - 1):
+                    yield chunk
+            yield ']'
+        elif depth and isinstance(obj, dict) and obj \
+                and not [key for key in obj if not isinstance(key, basestring)]:
+            yield '{'
+            first = True
+            for key, value in obj.iteritems():
+                if not first:
+                    yield ', '
+                first = False
+                yield self._encoder.encode(key)
+                yield ': '
+                for chunk in self.iterencode(value, depth - 1):
+                    yield chunk
+            yield '}'
+        else:
+            yield self._encoder.encode(obj)
+
+_codecs = {}
+
+def get_codec(backend='auto'):
+    """ Return the `JsonCodec` for the JSON library named `backend`. With
+    `'auto'` (or an unavailable library), a library with C speedups is
+    preferred. """
+    codec = _codecs.get(backend)
+    if codec is None:
+        module = json_backends.get(backend)
+        if module is None:
+            fast = [m for n, m in sorted(json_backends.items())
+                    if has_speedups(m)]
+            module = fast and fast[0] or json
+        codec = _codecs[backend] = JsonCodec(module)
+    return codec
+
 if json:
     class TracRpcJSONEncoder(json.JSONEncoder):
-        """ Extending the JSON encoder to support some additional types:
-        1. datetime.datetime => {'__jsonclass__': ["datetime", "<rfc3339str>"]}
-        2. tracrpc.api.Binary => {'__jsonclass__': ["binary", "<base64str>"]}
-        3. empty => ''
-        4. genshi.builder.Fragment|genshi.core.Markup => unicode
-        5. babel.support.LazyProxy => unicode
-        """
+        """ Extending the JSON encoder to support some additional types
+        (see `json_default()`). """
 
         def default(self, obj):
-            if isinstance(obj, datetime.datetime):
-                # http://www.ietf.org/rfc/rfc3339.txt
-                return {'__jsonclass__': ["datetime",
-                                obj.strftime('%Y-%m-%dT%H:%M:%S')]}
-            elif isinstance(obj, Binary):
-                return {'__jsonclass__': ["binary",
-                                obj.data.encode("base64")]}
-            elif obj is empty:
-                return ''
-            elif isinstance(obj, (genshi.builder.Fragment,
-                                  genshi.core.Markup)):
-                return unicode(obj)
-            elif babel and isinstance(obj, babel.support.LazyProxy):
-                return unicode(obj)
-            else:
-                return json.JSONEncoder(self, obj)
+            return json_default(obj)
 
     class TracRpcJSONDecoder(json.JSONDecoder):
-        """ Extending the JSON decoder to support some additional types:
-        1. {'__jsonclass__': ["datetime", "<rfc3339str>"]} => datetime.datetime
-        2. {'__jsonclass__': ["binary", "<base64str>"]} => tracrpc.api.Binary """
+        """ Extending the JSON decoder to support some additional types
+        (see `json_object_hook()`). """
 
-        dt = re.compile(
-            '^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,}))?')
-
-        def _normalize(self, obj):
-            """ Helper to traverse JSON decoded object for custom types. """
-            if isinstance(obj, tuple):
-                return tuple(self._normalize(item) for item in obj)
-            elif isinstance(obj, list):
-                return [self._normalize(item) for item in obj]
-            elif isinstance(obj, dict):
-                if obj.keys() == ['__jsonclass__']:
-                    kind, val = obj['__jsonclass__']
-                    if kind == 'datetime':
-                        dt = self.dt.match(val)
-                        if not dt:
-                            raise Exception(
-                                    "Invalid datetime string (%s)" % val)
-                        dt = tuple([int(i) for i in dt.groups() if i])
-                        kw_args = {'tzinfo': utc}
-                        return datetime.datetime(*dt, **kw_args)
-                    elif kind == 'binary':
-                        try:
-                            bin = val.decode("base64")
-                            return Binary(bin)
-                        except:
-                            raise Exception("Invalid base64 string")
-                    else:
-                        raise Exception("Unknown __jsonclass__: %s" % kind)
-                else:
-                    return dict(self._normalize(obj.items()))
-            elif isinstance(obj, basestring):
-                return to_unicode(obj)
-            else:
-                return obj
-
-        def decode(self, obj, *args, **kwargs):
-            obj = json.JSONDecoder.decode(self, obj, *args, **kwargs)
-            return self._normalize(obj)
+        def __init__(self, *args, **kwargs):
+            kwargs.setdefault('object_hook', json_object_hook)
+            json.JSONDecoder.__init__(self, *args, **kwargs)
 
     class JsonProtocolException(ProtocolException):
         """Impossible to handle JSON-RPC request."""
@@ -139,10 +222,17 @@ if json:
             * `{"__jsonclass__": ["binary", "<base64-encoded>"]} => Binary`
           * `"id"` is optional, and any marker value received with a
             request is returned with the response.
+          * JSON-RPC 2.0 batches (an array of calls) are executed like
+            `system.multicall`, and answered with an array of responses.
+            Calls without `"id"` are notifications, and get no response.
         """
 
         implements(IRPCProtocol)
 
+        json_backend = Option('rpc', 'json_backend', 'auto',
+            """JSON library used for JSON-RPC: `json`, `simplejson`, or
+            `auto` to use one with C speedups if installed.""")
+
         # IRPCProtocol methods
 
         def rpc_info(self):
@@ -160,38 +250,58 @@ if json:
                 raise JsonProtocolException("Error: JSON-RPC not available.\n")
 
             try:
-                data = json.load(req, cls=TracRpcJSONDecoder)
+                data = self._codec().load(RequestBody(req))
+            except HTTPRequestEntityTooLarge:
+                raise
             except Exception, e:
                 self.log.warning("RPC(json) decode error: %s",
                                  exception_to_unicode(e))
+                self._count('parse_errors')
                 raise JsonProtocolException(e, -32700)
+            if isinstance(data, list):
+                return self._parse_batch(data)
             if not isinstance(data, dict):
                 self.log.warning("RPC(json) decode error (not a dict)")
+                self._count('parse_errors')
                 raise JsonProtocolException('JSON object is not a dict',
                                             -32700)
 
             try:
                 self.log.info("RPC(json) JSON-RPC request ID : %s.", data.get('id'))
-                if data.get('method') == 'system.multicall':
+                if data.get('method') in MULTICALL_METHODS:
+                    self._count('multicalls')
                     # Prepare for multicall
-                    self.log.debug("RPC(json) Multicall request %s", data)
+                    self._log_payload("RPC(json) Multicall request %s", data)
                     params = data.get('params', [])
                     for signature in params :
                         signature['methodName'] = signature.get('method', '')
                     data['params'] = [params]
+                else:
+                    self._count('requests')
                 return data
             except Exception, e:
                 # Abort with exception - no data can be read
                 self.log.warning("RPC(json) decode error: %s",
                                  exception_to_unicode(e))
+                self._count('parse_errors')
                 raise JsonProtocolException(e, -32700)
 
         def send_rpc_result(self, req, result):
             """Send JSON-RPC response back to the caller."""
             rpcreq = req.rpc
             r_id = rpcreq.get('id')
+            version = rpcreq.get('jsonrpc')
+            self._count('results')
             try:
-                if rpcreq.get('method') == 'system.multicall': 
+                if rpcreq.get('batch'):
+                    args = rpcreq['params'][0]
+                    response = [self._batch_result(sig, value)
+                                for sig, value in izip(args, result)
+                                if 'id' in sig]
+                    if not response:
+                        # Only notifications, nothing to respond
+                        self._send_response(req, '', rpcreq['mimetype'])
+                elif rpcreq.get('method') in MULTICALL_METHODS:
                     # Custom multicall
                     args = (rpcreq.get('params') or [[]])[0]
                     mcresults = [self._json_result(
@@ -200,50 +310,118 @@ if json:
                                             sig.get('id') or r_id) \
                                   for sig, value in izip(args, result)]
                 
-                    response = self._json_result(mcresults, r_id)
+                    response = self._json_result(mcresults, r_id, version)
                 else:
-                    response = self._json_result(result, r_id)
-                try: # JSON encoding
-                    self.log.debug("RPC(json) result: %s" % repr(response))
-                    response = json.dumps(response, cls=TracRpcJSONEncoder)
-                except Exception, e:
-                    response = json.dumps(self._json_error(e, r_id=r_id),
-                                            cls=TracRpcJSONEncoder)
+                    response = self._json_result(result, r_id, version)
+            except RequestDone:
+                raise
             except Exception, e:
                 self.log.error("RPC(json) error %s" % exception_to_unicode(e,
                                                         traceback=True))
-                response = json.dumps(self._json_error(e, r_id=r_id),
-                                cls=TracRpcJSONEncoder)
-            self._send_response(req, response + '\n', rpcreq['mimetype'])
+                response = self._json_error(e, r_id=r_id, version=version)
+            self._log_payload("RPC(json) result: %s", response)
+            self._stream_response(req, response, r_id, rpcreq['mimetype'],
+                                  version)
 
         def send_rpc_error(self, req, e):
             """Send a JSON-RPC fault message back to the caller. """
             rpcreq = req.rpc
+            self._count('faults')
             r_id = rpcreq.get('id')
-            response = json.dumps(self._json_error(e, r_id=r_id), \
-                                      cls=TracRpcJSONEncoder)
+            response = self._codec().encode(self._json_error(e, r_id=r_id,
+                                            version=rpcreq.get('jsonrpc')))
             self._send_response(req, response + '\n', rpcreq['mimetype'])
 
         # Internal methods
 
+        def _parse_batch(self, calls):
+            """ Map a JSON-RPC 2.0 batch to a `system.multicall`, so that
+            the calls are executed by the same dispatcher (including
+            concurrent execution of read-only calls). """
+            if not calls:
+                self._count('parse_errors')
+                raise JsonProtocolException('Empty batch', -32600)
+            self._count('batches')
+            self._log_payload("RPC(json) Batch request %s", calls)
+            signatures = []
+            for call in calls:
+                # Invalid calls are not executed (no method name), and
+                # answered with an error
+                if not isinstance(call, dict) \
+                        or not isinstance(call.get('method'), basestring):
+                    signature = {'methodName': '', 'params': [], 'id': None,
+                                 'error': ('Invalid Request', -32600)}
+                elif isinstance(call.get('params'), dict):
+                    signature = {'methodName': '', 'params': [], 'error':
+                            ('Named parameters are not supported', -32602)}
+                    if 'id' in call:
+                        signature['id'] = call['id']
+                else:
+                    signature = dict(call)
+                    signature['methodName'] = call['method']
+                    signature['params'] = call.get('params') or []
+                signatures.append(signature)
+            return {'method': 'system.multicall', 'params': [signatures],
+                    'batch': True, 'jsonrpc': '2.0'}
+
+        def _batch_result(self, signature, value):
+            """ Create the response to a call in a batch. """
+            if signature.get('error'):
+                value = JsonProtocolException(*signature['error'])
+            elif not isinstance(value, Exception):
+                value = value[0]
+            return self._json_result(value, signature.get('id'), '2.0')
+
+        def _count(self, event):
+            RPCMetrics(self.env).count('JSON-RPC', event)
+
+        def _codec(self):
+            return get_codec(self.json_backend)
+
+        def _log_payload(self, message, *args):
+            log_payload(self.log, XMLRPCSystem(self.env).log_payload_size,
+                        message, *args)
+
+        def _stream_response(self, req, response, r_id, content_type,
+                             version=None):
+            """ Encode `response` incrementally, and write it in chunks
+            as it is produced. If encoding fails before anything is sent,
+            an error response for the request `version` is sent instead. """
+            stream = ResponseStream(req, content_type)
+            try:
+                for chunk in self._codec().iterencode(response):
+                    stream.write(chunk)
+                stream.write('\n')
+                stream.close()
+            except Exception, e:
+                if not stream.started:
+                    self._count('encode_errors')
+                    response = self._codec().encode(self._json_error(e,
+                                            r_id=r_id, version=version))
+                    self._send_response(req, response + '\n', content_type)
+                # Too late to send an error, the client gets a truncated
+                # response
+                self.log.error("RPC(json) result could not be sent: %s",
+                               exception_to_unicode(e))
+            raise RequestDone()
+
         def _send_response(self, req, response, content_type='application/json'):
-            self.log.debug("RPC(json) encoded response: %s" % response)
-            response = to_unicode(response).encode("utf-8")
-            req.send_response(200)
-            req.send_header('Content-Type', content_type)
-            req.send_header('Content-Length', len(response))
-            req.end_headers()
-            req.write(response)
+            self._log_payload("RPC(json) encoded response: %s", response)
+            stream = ResponseStream(req, content_type)
+            stream.write(to_unicode(response))
+            stream.close()
             raise RequestDone()
 
-        def _json_result(self, result, r_id=None):
+        def _json_result(self, result, r_id=None, version=None):
             """ Create JSON-RPC response dictionary. """
-            if not isinstance(result, Exception):
-                return {'result': result, 'error': None, 'id': r_id}
+            if isinstance(result, Exception):
+                return self._json_error(result, r_id=r_id, version=version)
+            elif version == '2.0':
+                return {'jsonrpc': '2.0', 'result': result, 'id': r_id}
             else :
-                return self._json_error(result, r_id=r_id)
+                return {'result': result, 'error': None, 'id': r_id}
 
-        def _json_error(self, e, c=None, r_id=None):
+        def _json_error(self, e, c=None, r_id=None, version=None):
             """ Makes a response dictionary that is an error. """
             if isinstance(e, MethodNotFound):
                 c = -32601
@@ -253,8 +431,10 @@ if json:
                 c = 404
             else:
                 c = c or hasattr(e, 'code') and e.code or -32603
-            return {'result': None, 'id': r_id, 'error': {
-                    'name': hasattr(e, 'name') and e.name or 'JSONRPCError',
-                    'code': c,
-                    'message': to_unicode(e)}}
+            error = {'name': hasattr(e, 'name') and e.name or 'JSONRPCError',
+                     'code': c,
+                     'message': to_unicode(e)}
+            if version == '2.0':
+                return {'jsonrpc': '2.0', 'error': error, 'id': r_id}
+            return {'result': None, 'id': r_id, 'error': error}
 
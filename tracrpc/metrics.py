@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009      ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+from bisect import bisect_left
+import threading
+import time
+import xmlrpclib
+
+from trac.core import *
+from trac.perm import IPermissionRequestor
+
+__all__ = ['RPCMetrics', 'summarize', 'get_query_counter',
+           'set_query_counter']
+
+# Phases of an RPC call, in order
+PHASES = ('parse', 'permission', 'execute', 'serialize')
+
+# Upper bounds (in seconds) of latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for calls that did not resolve to a known method
+UNKNOWN_METHOD = '(unknown)'
+
+class RPCMetrics(Component):
+    """ Collects per-method statistics of the RPC calls handled by
+    `RPCWeb`: number of calls and errors, latency histograms per phase of
+    the call, and request and response sizes. Protocols add their own
+    event counters through `count()`.
+
+    The statistics are published in Prometheus text format at
+    `/rpc/metrics` for users with `RPC_METRICS_VIEW` permission. """
+
+    implements(IPermissionRequestor)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+        self._events = {}
+
+    # IPermissionRequestor methods
+
+    def get_permission_actions(self):
+        yield 'RPC_METRICS_VIEW'
+
+    # Public methods
+
+    def recorder(self, req, protocol, count_queries=False):
+        """ Return a `CallRecorder` for an incoming request. If
+        `count_queries` is set, the recorder also counts the database
+        queries executed by the current thread, and by the threads the
+        call is handed to (see `set_query_counter()`).
+
+        Note that counting queries replaces `execute()` and
+        `executemany()` of Trac's `IterableCursor` class for as long as at
+        least one recorder is counting, which affects all cursors of the
+        process. Queries of other threads are not counted. """
+        return CallRecorder(self, req, protocol, count_queries)
+
+    def record(self, protocol, method, timings, error, request_size,
+               response_size):
+        """ Add a call to the statistics of `method`. `timings` is a
+        dictionary of phase name to seconds spent. """
+        key = (protocol, method or UNKNOWN_METHOD)
+        self._lock.acquire()
+        try:
+            stats = self._methods.get(key)
+            if stats is None:
+                stats = self._methods[key] = _new_stats()
+            stats['calls'] += 1
+            if error:
+                stats['errors'] += 1
+            stats['request_bytes'] += request_size
+            stats['response_bytes'] += response_size
+            for phase, seconds in timings.iteritems():
+                hist = stats['phases'][phase]
+                hist['buckets'][bisect_left(BUCKETS, seconds)] += 1
+                hist['count'] += 1
+                hist['sum'] += seconds
+        finally:
+            self._lock.release()
+
+    def count(self, protocol, event, n=1):
+        """ Increase the `event` counter of `protocol` by `n`. """
+        key = (protocol, event)
+        self._lock.acquire()
+        try:
+            self._events[key] = self._events.get(key, 0) + n
+        finally:
+            self._lock.release()
+
+    def events(self):
+        """ Return a copy of the protocol event counters as a dictionary
+        mapping `(protocol, event)` to count. """
+        self._lock.acquire()
+        try:
+            return dict(self._events)
+        finally:
+            self._lock.release()
+
+    def render_prometheus(self, extra=None):
+        """ Return the statistics in Prometheus text exposition format.
+        `extra` is an optional list of `(name, type, help, value)` gauges
+        or counters to add. """
+        methods = self.snapshot()
+        keys = sorted(methods)
+        out = []
+        def header(name, type, help):
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, type))
+        for name, field, help in (
+                ('calls_total', 'calls', 'Number of RPC calls.'),
+                ('errors_total', 'errors', 'Number of failed RPC calls.'),
+                ('request_bytes_total', 'request_bytes',
+                 'Size of RPC requests.'),
+                ('response_bytes_total', 'response_bytes',
+                 'Size of RPC responses.')):
+            header('tracrpc_' + name, 'counter', help)
+            for protocol, method in keys:
+                out.append('tracrpc_%s{%s} %s' % (name,
+                        _labels(protocol=protocol, method=method),
+                        methods[(protocol, method)][field]))
+        name = 'tracrpc_call_duration_seconds'
+        header(name, 'histogram', 'Time spent per phase of RPC calls.')
+        for protocol, method in keys:
+            for phase in PHASES:
+                hist = methods[(protocol, method)]['phases'][phase]
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',),
+                                        hist['buckets']):
+                    total += count
+                    out.append('%s_bucket{%s} %d' % (name,
+                            _labels(protocol=protocol, method=method,
+                                    phase=phase, le=bound), total))
+                labels = _labels(protocol=protocol, method=method,
+                                 phase=phase)
+                out.append('%s_sum{%s} %s' % (name, labels,
+                                              _value(hist['sum'])))
+                out.append('%s_count{%s} %d' % (name, labels, hist['count']))
+        events = self.events()
+        header('tracrpc_protocol_events_total', 'counter',
+               'Protocol events (requests, parse errors, results, faults).')
+        for protocol, event in sorted(events):
+            out.append('tracrpc_protocol_events_total{%s} %d' % (
+                    _labels(protocol=protocol, event=event),
+                    events[(protocol, event)]))
+        for name, type, help, value in extra or []:
+            header(name, type, help)
+            out.append('%s %s' % (name, _value(value)))
+        return '\n'.join(out) + '\n'
+
+    def snapshot(self):
+        """ Return a copy of the statistics as a dictionary mapping
+        `(protocol, method)` to a dictionary with `calls`, `errors`,
+        `request_bytes`, `response_bytes` and `phases` keys. `phases` maps
+        each phase to a `{'buckets', 'count', 'sum'}` histogram, where
+        `buckets` holds (non-cumulative) counts per upper bound in `BUCKETS`
+        followed by the count of slower calls. """
+        self._lock.acquire()
+        try:
+            result = {}
+            for key, stats in self._methods.iteritems():
+                copy = dict(stats)
+                copy['phases'] = dict([(phase, {'buckets': list(h['buckets']),
+                                                'count': h['count'],
+                                                'sum': h['sum']})
+                                for phase, h in stats['phases'].iteritems()])
+                result[key] = copy
+            return result
+        finally:
+            self._lock.release()
+
+def _labels(**labels):
+    def escape(value):
+        return unicode(value).replace('\\', '\\\\') \
+                             .replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(['%s="%s"' % (key, escape(labels[key]))
+                     for key in sorted(labels)])
+
+def _value(value):
+    """ Format a sample value (`repr()` of a `long` has an `L` suffix). """
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return repr(float(value))
+
+def summarize(value):
+    """ Describe `value` by its type and size, without its content. """
+    if isinstance(value, xmlrpclib.Binary):
+        return 'binary[%d]' % (hasattr(value, 'size') and value.size()
+                               or len(value.data))
+    if isinstance(value, (basestring, list, tuple, dict)):
+        return '%s[%d]' % (type(value).__name__, len(value))
+    return type(value).__name__
+
+def _new_stats():
+    return {'calls': 0, 'errors': 0, 'request_bytes': 0, 'response_bytes': 0,
+            'phases': dict([(phase, {'buckets': [0] * (len(BUCKETS) + 1),
+                                     'count': 0, 'sum': 0.0})
+                            for phase in PHASES])}
+
+class _QueryCounter(object):
+    """ Number of database queries executed for an RPC call. """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        self._lock.acquire()
+        try:
+            self.count += 1
+        finally:
+            self._lock.release()
+
+# `_QueryCounter` of the call handled by each thread, if counted
+_queries = threading.local()
+
+def get_query_counter():
+    """ Return the query counter of the current thread (or `None`), to
+    pass to `set_query_counter()` in threads executing part of the call. """
+    return getattr(_queries, 'counter', None)
+
+def set_query_counter(counter):
+    """ Count the queries of the current thread with `counter` (`None`
+    stops counting). """
+    _queries.counter = counter
+
+def _counting(execute):
+    def counting_execute(self, *args, **kwargs):
+        counter = getattr(_queries, 'counter', None)
+        if counter is not None:
+            counter.increment()
+        return execute(self, *args, **kwargs)
+    return counting_execute
+
+# Original cursor methods, and number of recorders counting queries
+_patch = {'originals': None, 'users': 0}
+_patch_lock = threading.Lock()
+
+def _install_query_counter():
+    """ Make the cursors handed out by Trac count executed queries, until
+    the matching `_uninstall_query_counter()` call. """
+    from trac.db.util import IterableCursor
+    _patch_lock.acquire()
+    try:
+        if _patch['users'] == 0:
+            _patch['originals'] = (IterableCursor.__dict__['execute'],
+                                   IterableCursor.__dict__['executemany'])
+            IterableCursor.execute = _counting(_patch['originals'][0])
+            IterableCursor.executemany = _counting(_patch['originals'][1])
+        _patch['users'] += 1
+    finally:
+        _patch_lock.release()
+
+def _uninstall_query_counter():
+    """ Restore the original cursor methods once no recorder counts
+    queries anymore. """
+    from trac.db.util import IterableCursor
+    _patch_lock.acquire()
+    try:
+        _patch['users'] -= 1
+        if _patch['users'] == 0:
+            IterableCursor.execute, IterableCursor.executemany = \
+                    _patch['originals']
+            _patch['originals'] = None
+    finally:
+        _patch_lock.release()
+
+class CallRecorder(object):
+    """ Measures a single RPC call: time spent per phase, bytes read and
+    written, and optionally the number of database queries. Call `phase()`
+    when entering each phase, and `finish()` when done. """
+
+    def __init__(self, metrics, req, protocol, count_queries=False):
+        self.metrics = metrics
+        self.protocol = protocol
+        self.method = None
+        self.error = False
+        self.timings = {}
+        self.queries = None
+        self.elapsed = None
+        self._counter = None
+        if count_queries:
+            _install_query_counter()
+            self._counter = _QueryCounter()
+            set_query_counter(self._counter)
+        self._phase = None
+        self._started = self.started = time.time()
+        try:
+            self.request_size = int(req.get_header('Content-Length') or 0)
+        except ValueError:
+            self.request_size = 0
+        self.response_size = 0
+        write = req.write
+        def counting_write(data):
+            self.response_size += len(data)
+            return write(data)
+        req.write = counting_write
+
+    def phase(self, name):
+        """ End the current phase, and start phase `name` (if any). """
+        now = time.time()
+        if self._phase is not None:
+            self.timings[self._phase] = self.timings.get(self._phase, 0) \
+                                        + now - self._started
+        self._phase = name
+        self._started = now
+
+    def finish(self):
+        self.phase(None)
+        self.elapsed = time.time() - self.started
+        if self._counter is not None:
+            set_query_counter(None)
+            _uninstall_query_counter()
+            self.queries = self._counter.count
+        self.metrics.record(self.protocol, self.method, self.timings,
+                            self.error, self.request_size, self.response_size)
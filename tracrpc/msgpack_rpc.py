@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009      ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+from itertools import izip
+
+try:
+    import babel
+except ImportError:
+    babel = None
+import genshi
+
+from trac.core import *
+from trac.perm import PermissionError
+from trac.resource import ResourceNotFound
+from trac.util.datefmt import utc
+from trac.util.text import to_unicode
+from trac.web.api import HTTPRequestEntityTooLarge, RequestDone
+
+from tracrpc.api import IRPCProtocol, XMLRPCSystem, Binary, \
+        MethodNotFound, ProtocolException, MULTICALL_METHODS
+from tracrpc.metrics import RPCMetrics
+from tracrpc.util import RequestBody, ResponseStream, \
+                         exception_to_unicode, empty, log_payload, prepare_docs
+
+__all__ = ['MsgpackRpcProtocol']
+
+try:
+    import msgpack
+    if not hasattr(msgpack, 'Timestamp'):
+        raise ImportError("msgpack >= 1.0 required.")
+except ImportError:
+    msgpack = None
+    __all__ = []
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=utc)
+
+def to_msgpack_timestamp(dt):
+    """ Convert a datetime.datetime object to a msgpack Timestamp """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=utc)
+    delta = dt - _epoch
+    return msgpack.Timestamp(delta.days * 86400 + delta.seconds,
+                             delta.microseconds * 1000)
+
+def from_msgpack_timestamp(ts):
+    """ Return datetime (in utc) from a msgpack Timestamp """
+    return _epoch + datetime.timedelta(seconds=ts.seconds,
+                                       microseconds=ts.nanoseconds // 1000)
+
+if msgpack:
+    class MsgpackProtocolException(ProtocolException):
+        """Impossible to handle MessagePack-RPC request."""
+        def __init__(self, details, code=-32603, title=None, show_traceback=False):
+            ProtocolException.__init__(self, details, title, show_traceback)
+            self.code = code
+
+    class MsgpackRpcProtocol(Component):
+        r"""
+        [http://msgpack.org/ MessagePack] is a compact binary alternative
+        to JSON, with libraries for all popular programming languages.
+        Requests and responses use the same structure as JSON-RPC, as maps
+        with `method`, `params` and `id` keys, and `result`, `error` and
+        `id` keys respectively (including `system.multicall`).
+
+        Binary data and datetimes use the native MessagePack types:
+          * `bin` values that are not valid UTF-8 are passed as `Binary`,
+            and `Binary` results returned as `bin` (no base64 encoding).
+            Other `bin` values are taken as text (clients packing Python 2
+            `str` as `bin`), except for arguments declared as `Binary` in
+            the method signature
+          * The timestamp extension type (-1) is used for datetimes (UTC)
+          * Text is always sent as `str` (UTF-8)
+
+        Example call using Python:
+
+        {{{
+        >>> import msgpack, urllib2
+        >>> body = msgpack.packb({'method': 'wiki.getPage',
+        ...                       'params': ['WikiStart'], 'id': 123})
+        >>> req = urllib2.Request('${req.abs_href.rpc()}', body,
+        ...                       {'Content-Type': 'application/msgpack'})
+        >>> msgpack.unpackb(urllib2.urlopen(req).read(), raw=False)
+        {u'id': 123, u'error': None, u'result': u'= Welcome to....
+        }}}
+        """
+
+        implements(IRPCProtocol)
+
+        # IRPCProtocol methods
+
+        def rpc_info(self):
+            return ('MessagePack-RPC', prepare_docs(self.__doc__))
+
+        def rpc_match(self):
+            yield ('rpc', 'application/msgpack')
+            yield ('rpc', 'application/x-msgpack')
+
+        def parse_rpc_request(self, req, content_type):
+            """ Parse MessagePack-RPC requests"""
+            try:
+                data = msgpack.unpackb(RequestBody(req).read(), raw=False)
+            except HTTPRequestEntityTooLarge:
+                raise
+            except Exception, e:
+                self.log.warning("RPC(msgpack) decode error: %s",
+                                 exception_to_unicode(e))
+                self._count('parse_errors')
+                raise MsgpackProtocolException(e, -32700)
+            if not isinstance(data, dict):
+                self.log.warning("RPC(msgpack) decode error (not a map)")
+                self._count('parse_errors')
+                raise MsgpackProtocolException('Request is not a map', -32700)
+            try:
+                data = self._normalize_input(data)
+                self._check_call(data)
+                data['params'] = data.get('params') or []
+                if data['method'] in MULTICALL_METHODS:
+                    self._count('multicalls')
+                    self._log_payload("RPC(msgpack) Multicall request %s",
+                                      data)
+                    params = data['params']
+                    for signature in params:
+                        if not isinstance(signature, dict):
+                            raise MsgpackProtocolException(
+                                    'Call is not a map', -32600)
+                        self._check_call(signature)
+                        signature['methodName'] = signature['method']
+                        signature['params'] = self._binary_args(
+                                                signature['methodName'],
+                                                signature.get('params') or [])
+                    data['params'] = [params]
+                else:
+                    self._count('requests')
+                    data['params'] = self._binary_args(data['method'],
+                                                       data['params'])
+                return data
+            except MsgpackProtocolException:
+                self.log.warning("RPC(msgpack) invalid request: %s", data)
+                self._count('parse_errors')
+                raise
+            except Exception, e:
+                # Abort with exception - no data can be read
+                self.log.warning("RPC(msgpack) decode error: %s",
+                                 exception_to_unicode(e))
+                self._count('parse_errors')
+                raise MsgpackProtocolException(e, -32700)
+
+        def send_rpc_result(self, req, result):
+            """Send MessagePack-RPC response back to the caller."""
+            rpcreq = req.rpc
+            r_id = rpcreq.get('id')
+            self._count('results')
+            try:
+                if rpcreq.get('method') in MULTICALL_METHODS:
+                    args = (rpcreq.get('params') or [[]])[0]
+                    result = [self._result(
+                                    isinstance(value, Exception) and value
+                                    or value[0], sig.get('id') or r_id)
+                              for sig, value in izip(args, result)]
+                response = self._result(result, r_id)
+            except Exception, e:
+                self.log.error("RPC(msgpack) error %s" % exception_to_unicode(
+                                                        e, traceback=True))
+                response = self._error(e, r_id=r_id)
+            self._log_payload("RPC(msgpack) result: %s", response)
+            stream = ResponseStream(req, rpcreq['mimetype'], encoding=None)
+            try:
+                for chunk in self._iterpack(response):
+                    stream.write(chunk)
+                stream.close()
+            except Exception, e:
+                if not stream.started:
+                    self._count('encode_errors')
+                    self._send_response(req, self._error(e, r_id=r_id),
+                                        rpcreq['mimetype'])
+                # Too late to send an error, the client gets a truncated
+                # response
+                self.log.error("RPC(msgpack) result could not be sent: %s",
+                               exception_to_unicode(e))
+            raise RequestDone()
+
+        def send_rpc_error(self, req, e):
+            """Send a MessagePack-RPC error back to the caller. """
+            rpcreq = req.rpc
+            self._count('faults')
+            self._send_response(req, self._error(e, r_id=rpcreq.get('id')),
+                                rpcreq['mimetype'])
+
+        # Internal methods
+
+        def _check_call(self, call):
+            """ Validate the `method` and `params` of a call map. """
+            if not isinstance(call.get('method'), basestring):
+                raise MsgpackProtocolException('Invalid method name', -32600)
+            if not isinstance(call.get('params') or [], (list, tuple)):
+                raise MsgpackProtocolException('Params is not an array',
+                                               -32600)
+
+        def _count(self, event):
+            RPCMetrics(self.env).count('MessagePack-RPC', event)
+
+        def _log_payload(self, message, *args):
+            log_payload(self.log, XMLRPCSystem(self.env).log_payload_size,
+                        message, *args)
+
+        def _send_response(self, req, response,
+                           content_type='application/msgpack'):
+            response = msgpack.packb(self._normalize_output(response),
+                                     use_bin_type=True)
+            stream = ResponseStream(req, content_type, encoding=None)
+            stream.write(response)
+            stream.close()
+            raise RequestDone()
+
+        def _iterpack(self, response, depth=3):
+            """ Pack `response` in pieces: the items of containers down to
+            `depth` levels (the response envelope, the result and its
+            items) are packed one at a time, so large results are written
+            as they are packed. """
+            if depth and isinstance(response, dict):
+                packer = msgpack.Packer(use_bin_type=True)
+                yield packer.pack_map_header(len(response))
+                for key, value in response.iteritems():
+                    yield packer.pack(self._normalize_output(key))
+                    for chunk in self._iterpack(value, depth - 1):
+                        yield chunk
+            elif depth and isinstance(response, (list, tuple)):
+                packer = msgpack.Packer(use_bin_type=True)
+                yield packer.pack_array_header(len(response))
+                for item in response:
+                    for chunk in self._iterpack(item, depth - 1):
+                        yield chunk
+            else:
+                yield msgpack.packb(self._normalize_output(response),
+                                    use_bin_type=True)
+
+        def _result(self, result, r_id=None):
+            """ Create response map. """
+            if isinstance(result, Exception):
+                return self._error(result, r_id=r_id)
+            return {'result': result, 'error': None, 'id': r_id}
+
+        def _error(self, e, c=None, r_id=None):
+            """ Create response map for an error. """
+            if isinstance(e, MethodNotFound):
+                c = -32601
+            elif isinstance(e, PermissionError):
+                c = 403
+            elif isinstance(e, ResourceNotFound):
+                c = 404
+            else:
+                c = c or hasattr(e, 'code') and e.code or -32603
+            return {'result': None, 'id': r_id, 'error': {
+                    'name': hasattr(e, 'name') and e.name or 'RPCError',
+                    'code': c,
+                    'message': to_unicode(e)}}
+
+        def _binary_args(self, method, params):
+            """ Turn text arguments back into `Binary` where the signature
+            of `method` (with as many arguments) expects binary data. """
+            try:
+                signatures = XMLRPCSystem(self.env).get_method(method) \
+                                                   .rpc_signatures
+            except (MethodNotFound, TypeError):
+                return params
+            positions = set([i for sig in signatures
+                             if len(sig) == len(params) + 1
+                             for i, type_ in enumerate(sig[1:])
+                             if type_ is Binary])
+            return [i in positions and isinstance(param, unicode)
+                    and Binary(param.encode('utf-8')) or param
+                    for i, param in enumerate(params)]
+
+        def _normalize_input(self, args):
+            """ Normalizes arguments (at any level - traversing maps and
+            arrays):
+            1. `bin` (`str`) => unicode if valid UTF-8, else
+               tracrpc.api.Binary
+            2. msgpack.Timestamp => datetime (UTC)
+            """
+            if isinstance(args, list):
+                return [self._normalize_input(arg) for arg in args]
+            elif isinstance(args, dict):
+                return dict([(key, self._normalize_input(value))
+                             for key, value in args.iteritems()])
+            elif isinstance(args, str):
+                try:
+                    return args.decode('utf-8')
+                except UnicodeDecodeError:
+                    return Binary(args)
+            elif isinstance(args, msgpack.Timestamp):
+                return from_msgpack_timestamp(args)
+            return args
+
+        def _normalize_output(self, result):
+            """ Normalizes and converts output (traversing it):
+            1. empty => None
+            2. datetime => msgpack.Timestamp
+            3. Binary => `bin` (`str`)
+            4. `str` and genshi.builder.Fragment|genshi.core.Markup =>
+               unicode (sent as MessagePack `str`)
+            """
+            if result is None or result is empty:
+                return None
+            elif isinstance(result, Binary):
+                return result.data
+            elif isinstance(result, (str, genshi.builder.Fragment,
+                                     genshi.core.Markup)):
+                return to_unicode(result)
+            elif babel and isinstance(result, babel.support.LazyProxy):
+                return to_unicode(result)
+            elif isinstance(result, datetime.datetime):
+                return to_msgpack_timestamp(result)
+            elif isinstance(result, dict):
+                return dict([(self._normalize_output(key),
+                              self._normalize_output(value))
+                             for key, value in result.iteritems()])
+            elif isinstance(result, (list, tuple)):
+                return [self._normalize_output(item) for item in result]
+            return result
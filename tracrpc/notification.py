@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009      ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import thread
+import threading
+import time
+
+from trac.config import BoolOption, IntOption
+from trac.core import *
+from trac.db import Table, Column, DatabaseManager
+from trac.env import IEnvironmentSetupParticipant
+from trac.resource import ResourceNotFound
+import trac.ticket.model as model
+from trac.ticket.notification import TicketNotifyEmail
+from trac.web.api import IRequestFilter
+
+from tracrpc.util import call_after_commit, db_query, exception_to_unicode, \
+                         from_utimestamp, run_in_transaction, to_utimestamp
+
+__all__ = ['NotificationQueue']
+
+SCHEMA_NAME = 'tracrpc_notify_spool'
+SCHEMA_VERSION = 1
+
+SCHEMA = [
+    Table('rpc_notify_spool', key='id')[
+        Column('id', auto_increment=True),
+        Column('ticket', type='int'),
+        Column('newticket', type='int'),
+        Column('modtime', type='int64'),
+        Column('queued', type='int64'),
+        Column('attempts', type='int'),
+        Column('claimed', type='int64')],
+]
+
+# Time (in microseconds) after which a notification claimed by a worker
+# that did not complete it (process restarted or crashed) is sent again
+LEASE_TIMEOUT = 10 * 60 * 1000000
+
+# Queue running the worker thread of each environment (by path). When an
+# environment is reloaded, the worker of the previous instance is stopped.
+_queues = {}
+_queues_lock = threading.Lock()
+
+def _now():
+    return long(time.time() * 1000000)
+
+class NotificationQueue(Component):
+    """ Sends ticket notifications for RPC calls from a background thread.
+
+    Notifications are stored in the `rpc_notify_spool` table as part of the
+    transaction making the change, and sent by a worker thread after
+    commit. The worker leases an entry while sending it, and deletes it
+    once sent: entries left over by a restart or crash are sent again when
+    their lease expires. The worker is (re)started by incoming requests,
+    and checks the spool every minute until `stop()` is called, or the
+    environment is reloaded. """
+
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
+
+    enabled = BoolOption('rpc', 'async_notifications', 'false',
+        """Send ticket notifications requested by RPC calls from a
+        background thread, instead of making the caller wait for the
+        mail to be sent.""")
+
+    max_attempts = IntOption('rpc', 'async_notifications_attempts', 3,
+        """Number of times the background thread tries to send a
+        notification before giving up.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._worker = None
+        self._pending = False
+        self._stopped = False
+        self._stats = {'queued': 0, 'sent': 0, 'failed': 0,
+                       'latency_total': 0.0, 'latency_max': 0.0}
+        if self.enabled and self._schema_installed():
+            # Deliver notifications left over from previous runs
+            self.wake()
+
+    # IEnvironmentSetupParticipant methods
+
+    def environment_created(self):
+        if self.enabled:
+            self.upgrade_environment(None)
+
+    def environment_needs_upgrade(self, db=None):
+        # The spool is only created for environments that use it
+        return self.enabled and not self._schema_installed()
+
+    def upgrade_environment(self, db=None):
+        connector = DatabaseManager(self.env)._get_connector()[0]
+        def do_upgrade(db):
+            cursor = db.cursor()
+            for table in SCHEMA:
+                for stmt in connector.to_sql(table):
+                    cursor.execute(stmt)
+            cursor.execute("INSERT INTO system (name,value) VALUES (%s,%s)",
+                           (SCHEMA_NAME, str(SCHEMA_VERSION)))
+        if db is not None:
+            do_upgrade(db)
+        else:
+            run_in_transaction(self.env, do_upgrade)
+
+    # Public methods
+
+    def enqueue(self, req, ticket_id, newticket, modtime=None):
+        """ Add a notification for ticket `ticket_id` to the spool, as part
+        of the current transaction (if any). The worker thread is woken up
+        once the change has been committed. """
+        if modtime is not None:
+            modtime = to_utimestamp(modtime)
+        def do_insert(db):
+            db.cursor().execute("INSERT INTO rpc_notify_spool "
+                "(ticket,newticket,modtime,queued,attempts,claimed) "
+                "VALUES (%s,%s,%s,%s,0,0)",
+                (ticket_id, int(bool(newticket)), modtime, _now()))
+        run_in_transaction(self.env, do_insert)
+        self._count('queued')
+        call_after_commit(req, self.wake)
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if self.enabled:
+            self._wakeup.acquire()
+            try:
+                running = self._worker is not None and self._worker.isAlive()
+            finally:
+                self._wakeup.release()
+            if not running and self._schema_installed():
+                self.wake()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def wake(self):
+        """ Start the worker thread, or wake it up if already running. """
+        started = False
+        self._wakeup.acquire()
+        try:
+            if self._stopped:
+                return
+            if self._worker is None or not self._worker.isAlive():
+                self._worker = threading.Thread(target=self._run,
+                                        name='tracrpc-notification-queue')
+                self._worker.setDaemon(True)
+                self._worker.start()
+                started = True
+            self._pending = True
+            self._wakeup.notify()
+        finally:
+            self._wakeup.release()
+        if started:
+            self._replace_worker()
+
+    def stop(self):
+        """ Stop the worker thread (once done with the notification being
+        sent, if any). Pending notifications stay in the spool. """
+        self._wakeup.acquire()
+        try:
+            self._stopped = True
+            self._wakeup.notify()
+        finally:
+            self._wakeup.release()
+
+    def depth(self):
+        """ Number of notifications waiting to be sent. """
+        for count, in db_query(self.env,
+                               "SELECT COUNT(*) FROM rpc_notify_spool"):
+            return count
+
+    def stats(self):
+        """ Return a dictionary of counters: `queued`, `sent` and `failed`
+        notifications, `depth` of the spool, and `latency_avg` and
+        `latency_max` (in seconds) from enqueueing to sending. """
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._lock.release()
+        done = stats['sent'] + stats['failed']
+        stats['latency_avg'] = done and stats['latency_total'] / done or 0.0
+        del stats['latency_total']
+        stats['depth'] = self.depth()
+        return stats
+
+    # Internal methods
+
+    def _schema_installed(self):
+        for value, in db_query(self.env,
+                "SELECT value FROM system WHERE name=%s", (SCHEMA_NAME,)):
+            return int(value) >= SCHEMA_VERSION
+        return False
+
+    def _count(self, name, latency=None):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+            if latency is not None:
+                self._stats['latency_total'] += latency
+                self._stats['latency_max'] = max(latency,
+                                                 self._stats['latency_max'])
+        finally:
+            self._lock.release()
+
+    def _replace_worker(self):
+        """ Register this queue as the one running the worker for the
+        environment, and stop the worker of a previous instance of the
+        environment (reloaded). """
+        _queues_lock.acquire()
+        try:
+            previous = _queues.get(self.env.path)
+            _queues[self.env.path] = self
+        finally:
+            _queues_lock.release()
+        if previous is not None and previous is not self:
+            previous.stop()
+
+    def _run(self):
+        while True:
+            self._wakeup.acquire()
+            try:
+                if self._stopped:
+                    return
+                self._pending = False
+            finally:
+                self._wakeup.release()
+            try:
+                try:
+                    done = self._process_spool()
+                except Exception, e:
+                    self.log.error("RPC notification queue: %s",
+                                   exception_to_unicode(e, traceback=True))
+                    done = 0
+            finally:
+                # Release database connection(s) held by this thread
+                self.env.shutdown(thread.get_ident())
+            if not done:
+                self._wakeup.acquire()
+                try:
+                    if not self._pending and not self._stopped:
+                        self._wakeup.wait(60)
+                finally:
+                    self._wakeup.release()
+
+    def _process_spool(self, batch_size=50):
+        """ Send a batch of notifications that are not leased (or whose
+        lease expired), and return the number of notifications done with
+        (not released for another attempt). """
+        rows = list(db_query(self.env,
+                "SELECT id,ticket,newticket,modtime,queued,attempts,claimed "
+                "FROM rpc_notify_spool WHERE claimed=0 OR claimed<%s "
+                "ORDER BY id LIMIT %s", (_now() - LEASE_TIMEOUT, batch_size)))
+        done = 0
+        for row in rows:
+            if self._stopped:
+                break
+            spool_id, claimed = row[0], row[6]
+            if not self._claim(spool_id, claimed):
+                continue
+            if self._send(spool_id, *row[1:6]):
+                done += 1
+        return done
+
+    def _claim(self, spool_id, claimed):
+        """ Lease an entry of the spool (still leased as `claimed`) and
+        count the attempt. Return `True` unless another worker leased it
+        first. """
+        leased = []
+        def do_lease(db):
+            cursor = db.cursor()
+            cursor.execute("UPDATE rpc_notify_spool "
+                           "SET claimed=%s,attempts=attempts+1 "
+                           "WHERE id=%s AND claimed=%s",
+                           (_now(), spool_id, claimed))
+            leased.append(cursor.rowcount != 0)
+        run_in_transaction(self.env, do_lease)
+        return leased[0]
+
+    def _release(self, spool_id):
+        def do_release(db):
+            db.cursor().execute("UPDATE rpc_notify_spool SET claimed=0 "
+                                "WHERE id=%s", (spool_id,))
+        run_in_transaction(self.env, do_release)
+
+    def _remove(self, spool_id):
+        def do_delete(db):
+            db.cursor().execute("DELETE FROM rpc_notify_spool WHERE id=%s",
+                                (spool_id,))
+        run_in_transaction(self.env, do_delete)
+
+    def _send(self, spool_id, ticket_id, newticket, modtime, queued,
+              attempts):
+        """ Send a leased notification (for attempt `attempts + 1`), and
+        remove it from the spool. Return `False` if it was released for
+        another attempt instead. """
+        attempts += 1
+        try:
+            if attempts > self.max_attempts:
+                # Earlier attempts did not complete (worker died)
+                raise Exception("%d attempts did not complete"
+                                % (attempts - 1))
+            t = model.Ticket(self.env, ticket_id)
+            tn = TicketNotifyEmail(self.env)
+            tn.notify(t, newticket=bool(newticket),
+                      modtime=modtime is not None and
+                              from_utimestamp(modtime) or None)
+        except ResourceNotFound:
+            self.log.info("RPC notification queue: ticket #%s was deleted",
+                          ticket_id)
+            self._remove(spool_id)
+            self._count('failed', (_now() - queued) / 1000000.0)
+        except Exception, e:
+            self.log.error("Failure sending notification on %s of ticket "
+                           "#%s (attempt %d): %s", newticket and 'creation'
+                           or 'change', ticket_id, attempts,
+                           exception_to_unicode(e))
+            if attempts < self.max_attempts:
+                self._release(spool_id)
+                return False
+            self._remove(spool_id)
+            self._count('failed', (_now() - queued) / 1000000.0)
+        else:
+            self._remove(spool_id)
+            self._count('sent', (_now() - queued) / 1000000.0)
+        return True
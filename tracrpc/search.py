@@ -11,7 +11,7 @@ from trac.search.api import ISearchSource
 from trac.search.web_ui import SearchModule
 from trac.util.compat import set
 
-from tracrpc.api import IXMLRPCHandler
+from tracrpc.api import IXMLRPCHandler, read_only
 
 __all__ = ['SearchRPC']
 
@@ -30,6 +30,7 @@ class SearchRPC(Component):
         yield ('SEARCH_VIEW', ((list, str), (list, str, list)), self.performSearch)
 
     # Others
+    @read_only
     def getSearchFilters(self, req):
         """ Retrieve a list of search filters with each element in the form
             (name, description). """
@@ -37,6 +38,7 @@ class SearchRPC(Component):
             for filter in source.get_search_filters(req):
                 yield filter
 
+    @read_only
     def performSearch(self, req, query, filters=None):
         """ Perform a search using the given filters. Defaults to all if not
             provided. Results are returned as a list of tuples in the form
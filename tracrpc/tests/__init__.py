@@ -69,6 +69,8 @@ try:
         suite.addTest(tracrpc.tests.xml_rpc.test_suite())
         import tracrpc.tests.json_rpc
         suite.addTest(tracrpc.tests.json_rpc.test_suite())
+        import tracrpc.tests.msgpack_rpc
+        suite.addTest(tracrpc.tests.msgpack_rpc.test_suite())
         import tracrpc.tests.ticket
         suite.addTest(tracrpc.tests.ticket.test_suite())
         import tracrpc.tests.wiki
@@ -77,6 +79,8 @@ try:
         suite.addTest(tracrpc.tests.web_ui.test_suite())
         import tracrpc.tests.search
         suite.addTest(tracrpc.tests.search.test_suite())
+        import tracrpc.tests.metrics
+        suite.addTest(tracrpc.tests.metrics.test_suite())
         return suite
 
 except Exception, e:
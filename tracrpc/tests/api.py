@@ -133,8 +133,125 @@ class ProtocolProviderTestCase(TracRpcTestCase):
             os.unlink(provider)
             rpc_testenv.restart()
 
+class RpcMethodIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from trac.test import EnvironmentStub
+        from tracrpc.api import XMLRPCSystem
+        self.env = EnvironmentStub(enable=['trac.*', 'tracrpc.*'])
+        self.system = XMLRPCSystem(self.env)
+
+    def _has_method(self, name):
+        from tracrpc.api import MethodNotFound
+        try:
+            self.system.get_method(name)
+        except MethodNotFound:
+            return False
+        return True
+
+    def test_method_index_follows_providers(self):
+        from tracrpc.search import SearchRPC
+        # The index is rebuilt in-process when providers are enabled
+        # or disabled
+        self.assertTrue(self._has_method('search.performSearch'))
+        self.env.disable_component(SearchRPC)
+        self.assertFalse(self._has_method('search.performSearch'))
+        self.assertFalse('search.performSearch' in
+                         [m.name for m in self.system.all_methods(None)])
+        self.assertTrue(self._has_method('wiki.getPage'))
+        self.env.enable_component(SearchRPC)
+        self.assertTrue(self._has_method('search.performSearch'))
+
+class PayloadReprTestCase(unittest.TestCase):
+
+    def test_abbreviates_binary(self):
+        import xmlrpclib
+        from tracrpc.util import PayloadRepr
+        data = xmlrpclib.Binary('x' * 1000000)
+        self.assertEquals("['file.txt', <Binary 1000000 bytes>]",
+                          str(PayloadRepr(['file.txt', data], 100)))
+
+    def test_truncates(self):
+        from tracrpc.util import PayloadRepr
+        text = str(PayloadRepr(u'\xe5' * 10000, 50))
+        self.assertEquals(50, len(text))
+        self.assertTrue('...' in text)
+        self.assertEquals("{'a': 1}", str(PayloadRepr({'a': 1}, 50)))
+
+class ReadOnlyMethodTestCase(unittest.TestCase):
+
+    def _info(self, func):
+        from tracrpc.api import MethodInfo
+        provider = Mock(xmlrpc_namespace=lambda: 'test_ro')
+        return MethodInfo(provider, 'WIKI_VIEW', [(str,)], func)
+
+    def test_declared(self):
+        from tracrpc.api import read_only
+        def getThing(req):
+            """ Lookup. """
+        self.assertEquals(True, self._info(read_only(getThing)).read_only)
+
+    def test_undeclared(self):
+        # Method names are not used to guess side-effects
+        def getAndIncrement(req):
+            """ Update. """
+        self.assertEquals(False, self._info(getAndIncrement).read_only)
+
+class _Checks(object):
+    """ Counts the permission checks made through `req.perm(resource)`. """
+
+    def __init__(self, perm):
+        self.perm = perm
+        self.count = 0
+
+    def __call__(self, resource):
+        self.count += 1
+        return self.perm(resource)
+
+class FilterResourcesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from trac.perm import IPermissionPolicy, PermissionCache
+        from trac.test import EnvironmentStub
+        class RpcTestPrivateTicketPolicy(Component):
+            implements(IPermissionPolicy)
+            def check_permission(self, action, username, resource, perm):
+                if resource and resource.realm == 'ticket' \
+                        and resource.id == 2:
+                    return False
+        self.env = EnvironmentStub(default_data=True,
+                        enable=['trac.*', RpcTestPrivateTicketPolicy])
+        self.checks = _Checks(PermissionCache(self.env, 'anonymous'))
+        self.req = Mock(perm=self.checks)
+
+    def _filter(self, ids):
+        from trac.resource import Resource
+        from tracrpc.util import filter_resources
+        ticket_realm = Resource('ticket')
+        return list(filter_resources(self.env, self.req, 'TICKET_VIEW', ids,
+                                     lambda tid: ticket_realm(id=tid)))
+
+    def test_per_realm(self):
+        # Default policies: a single check for the realm
+        self.assertEquals([1, 2, 3, 2], self._filter([1, 2, 3, 2]))
+        self.assertEquals(1, self.checks.count)
+
+    def test_per_resource(self):
+        self.env.config.set('trac', 'permission_policies',
+                            'RpcTestPrivateTicketPolicy, '
+                            'DefaultPermissionPolicy, LegacyAttachmentPolicy')
+        self.assertEquals([1, 3], self._filter([1, 2, 3, 2]))
+        # Each distinct resource is checked once
+        self.assertEquals(3, self.checks.count)
+
 def test_suite():
-    return unittest.makeSuite(ProtocolProviderTestCase)
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(ProtocolProviderTestCase))
+    test_suite.addTest(unittest.makeSuite(RpcMethodIndexTestCase))
+    test_suite.addTest(unittest.makeSuite(PayloadReprTestCase))
+    test_suite.addTest(unittest.makeSuite(ReadOnlyMethodTestCase))
+    test_suite.addTest(unittest.makeSuite(FilterResourcesTestCase))
+    return test_suite
 
 if __name__ == '__main__':
     unittest.main(defaultTest='test_suite')
@@ -120,6 +120,41 @@ else:
             self.assertEquals(None, items[3]['result'])
             self.assertEquals('JSONRPCError', items[3]['error']['name'])
 
+        def test_batch(self):
+            data = [
+                {'jsonrpc': '2.0', 'method': 'wiki.getAllPages', 'id': 1},
+                {'jsonrpc': '2.0', 'method': 'ticket.status.getAll',
+                 'params': [], 'id': 'two'},
+                {'jsonrpc': '2.0', 'method': 'system.getAPIVersion'},
+                {'jsonrpc': '2.0', 'method': 'nonexisting', 'id': 4},
+                {'jsonrpc': '2.0', 'method': 'wiki.getPage',
+                 'params': {'pagename': 'WikiStart'}, 'id': 5},
+                42]
+            result = self._anon_req(data)
+            self.assertEquals(5, len(result))
+            self.assertEquals([1, 'two', 4, 5, None],
+                              [item['id'] for item in result])
+            self.assertTrue('WikiStart' in result[0]['result'])
+            self.assertFalse('error' in result[0])
+            self.assertEquals('2.0', result[0]['jsonrpc'])
+            self.assertEquals(['accepted', 'assigned', 'closed', 'new',
+                               'reopened'], result[1]['result'])
+            self.assertEquals(-32601, result[2]['error']['code'])
+            self.assertFalse('result' in result[2])
+            self.assertEquals(-32602, result[3]['error']['code'])
+            self.assertEquals(-32600, result[4]['error']['code'])
+
+        def test_batch_notifications(self):
+            req = urllib2.Request(rpc_testenv.url_anon,
+                        headers={'Content-Type': 'application/json'},
+                        data=json.dumps([{'jsonrpc': '2.0',
+                                          'method': 'system.getAPIVersion'}]))
+            self.assertEquals('', urllib2.urlopen(req).read())
+
+        def test_batch_empty(self):
+            result = self._anon_req([])
+            self.assertEquals(-32600, result['error']['code'])
+
         def test_datetime(self):
             # read and write datetime values
             from datetime import datetime
@@ -156,6 +191,65 @@ else:
                     result['result']['__jsonclass__'][1].decode("base64"))
             self.assertEquals(image_in.getvalue(), image_out.getvalue())
 
+        def test_large_response(self):
+            # Encoded and sent in several chunks
+            text = u'R\xe9sum\xe9 "quoted" \\ ' * 10000
+            result = self._auth_req({'method': 'wiki.putPage',
+                    'params': ['LargeJsonResponse', text, {}]}, user='admin')
+            self.assertEquals(None, result['error'])
+            try:
+                result = self._auth_req({'method': 'wiki.getPage',
+                        'params': ['LargeJsonResponse'], 'id': 42})
+                self.assertEquals(None, result['error'])
+                self.assertEquals(42, result['id'])
+                self.assertEquals(text, result['result'])
+            finally:
+                self._auth_req({'method': 'wiki.deletePage',
+                        'params': ['LargeJsonResponse']}, user='admin')
+
+        def test_codec(self):
+            from datetime import datetime
+            from trac.util.datefmt import utc
+            from tracrpc.api import Binary
+            from tracrpc.json_rpc import get_codec, json_backends
+            dt = datetime(2009, 6, 19, 16, 46, tzinfo=utc)
+            response = {'id': 1, 'error': None, 'result': [
+                            {'time': dt, 'data': Binary('\x00\xff'), 1: 2},
+                            [u'\xe5', None, 1.5]]}
+            for backend in ['auto'] + json_backends.keys():
+                codec = get_codec(backend)
+                encoded = ''.join(codec.iterencode(response))
+                self.assertEquals(json.loads(codec.encode(response)),
+                                  json.loads(encoded))
+                decoded = codec.decode(encoded)['result']
+                self.assertEquals(dt, decoded[0]['time'])
+                self.assertEquals('\x00\xff', decoded[0]['data'].data)
+                self.assertEquals([u'\xe5', None, 1.5], decoded[1])
+
+        def test_stream_encode_error(self):
+            from trac.core import TracError
+            from trac.test import EnvironmentStub, Mock
+            from trac.web.api import RequestDone
+            from tracrpc.json_rpc import JsonRpcProtocol
+            env = EnvironmentStub(enable=['trac.*', 'tracrpc.*'])
+            protocol = JsonRpcProtocol(env)
+            for version, expected in [('2.0', {'jsonrpc': '2.0'}),
+                                      (None, {'result': None})]:
+                out = []
+                req = Mock(send_response=lambda code: None,
+                           send_header=lambda name, value: None,
+                           end_headers=lambda: None, get_header=lambda n: None,
+                           write=out.append)
+                # Nothing sent yet when encoding fails: error response
+                self.assertRaises(RequestDone, protocol._stream_response,
+                                  req, {'result': TracError('unencodable')},
+                                  7, 'application/json', version)
+                response = json.loads(''.join(out))
+                self.assertEquals(7, response['id'])
+                self.assertEquals(-32603, response['error']['code'])
+                for key, value in expected.items():
+                    self.assertEquals(value, response[key])
+
         def test_fragment(self):
             data = {'method': 'ticket.create',
                     'params': ['ticket10786', '',
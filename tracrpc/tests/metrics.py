@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009-2013 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import unittest
+import urllib2
+import xmlrpclib
+
+from tracrpc.tests import rpc_testenv, TracRpcTestCase
+
+from tracrpc.metrics import RPCMetrics, BUCKETS, UNKNOWN_METHOD, summarize
+
+class RpcMetricsTestCase(TracRpcTestCase):
+
+    def setUp(self):
+        TracRpcTestCase.setUp(self)
+        self.metrics = RPCMetrics(rpc_testenv.get_trac_environment())
+
+    def tearDown(self):
+        TracRpcTestCase.tearDown(self)
+
+    def test_record(self):
+        self.metrics.record('XML-RPC', 'test.metrics',
+                {'parse': 0.001, 'execute': 0.3, 'serialize': 20.0},
+                False, 100, 2000)
+        self.metrics.record('XML-RPC', 'test.metrics', {'parse': 0.001},
+                True, 50, 10)
+        stats = self.metrics.snapshot()[('XML-RPC', 'test.metrics')]
+        self.assertEquals(2, stats['calls'])
+        self.assertEquals(1, stats['errors'])
+        self.assertEquals(150, stats['request_bytes'])
+        self.assertEquals(2010, stats['response_bytes'])
+        parse = stats['phases']['parse']
+        self.assertEquals(2, parse['count'])
+        self.assertEquals(2, parse['buckets'][0])
+        execute = stats['phases']['execute']
+        self.assertEquals(1, execute['buckets'][list(BUCKETS).index(0.5)])
+        serialize = stats['phases']['serialize']
+        self.assertEquals(1, serialize['buckets'][-1])
+        self.assertEquals(0, stats['phases']['permission']['count'])
+
+    def test_unknown_method(self):
+        self.metrics.record('JSON-RPC', None, {}, True, 0, 0)
+        self.assertTrue(('JSON-RPC', UNKNOWN_METHOD)
+                        in self.metrics.snapshot())
+
+    def test_summarize(self):
+        self.assertEquals('str[3]', summarize('abc'))
+        self.assertEquals('unicode[2]', summarize(u'\xe5\xe6'))
+        self.assertEquals('binary[5]', summarize(xmlrpclib.Binary('12345')))
+        self.assertEquals('list[2]', summarize([1, [2, 3]]))
+        self.assertEquals('dict[1]', summarize({'summary': 'x' * 1000}))
+        self.assertEquals('int', summarize(42))
+
+    def test_render_values(self):
+        body = self.metrics.render_prometheus([
+                ('test_depth', 'gauge', 'Long value.', 5L),
+                ('test_latency', 'gauge', 'Float value.', 0.25),
+                ('test_count', 'counter', 'Int value.', 3)])
+        self.assertTrue('\ntest_depth 5\n' in body)
+        self.assertTrue('\ntest_latency 0.25\n' in body)
+        self.assertTrue('\ntest_count 3\n' in body)
+        self.assertFalse('L\n' in body)
+
+    def test_query_counter(self):
+        import thread
+        import threading
+        from trac.db.util import IterableCursor
+        from trac.test import EnvironmentStub, Mock
+        from tracrpc.metrics import get_query_counter, set_query_counter
+        env = EnvironmentStub()
+        execute = IterableCursor.__dict__['execute']
+        def query():
+            db = env.get_read_db()
+            db.cursor().execute("SELECT 1")
+        req = Mock(get_header=lambda name: None, write=lambda data: None)
+        recorder = self.metrics.recorder(req, 'XML-RPC', count_queries=True)
+        query()
+        # Queries of threads executing part of the call are counted
+        counter = get_query_counter()
+        def worker():
+            set_query_counter(counter)
+            try:
+                query()
+                query()
+            finally:
+                set_query_counter(None)
+                env.shutdown(thread.get_ident())
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        # ... but not queries of other threads
+        t = threading.Thread(target=query)
+        t.start()
+        t.join()
+        recorder.finish()
+        self.assertEquals(3, recorder.queries)
+        self.assertEquals(None, get_query_counter())
+        # Cursors are restored once no call is counted
+        self.assertTrue(IterableCursor.__dict__['execute'] is execute)
+
+    def test_prometheus_endpoint(self):
+        url = rpc_testenv.url_anon + '/metrics'
+        try:
+            urllib2.urlopen(url)
+            self.fail("Expected HTTP 403")
+        except urllib2.HTTPError, e:
+            self.assertEquals(403, e.code)
+        rpc_testenv._tracadmin('permission', 'add', 'anonymous',
+                               'RPC_METRICS_VIEW', wait=True)
+        try:
+            xmlrpclib.ServerProxy(rpc_testenv.url_anon).system.getAPIVersion()
+            response = urllib2.urlopen(url)
+            self.assertTrue(response.info()['Content-Type'].startswith(
+                            'text/plain'))
+            body = response.read()
+            self.assertTrue('# TYPE tracrpc_calls_total counter' in body)
+            self.assertTrue('tracrpc_calls_total{method="system.getAPIVersion"'
+                            ',protocol="XML-RPC"}' in body)
+            self.assertTrue('tracrpc_protocol_events_total{event="requests",'
+                            'protocol="XML-RPC"}' in body)
+        finally:
+            rpc_testenv._tracadmin('permission', 'remove', 'anonymous',
+                                   'RPC_METRICS_VIEW', wait=True)
+
+def test_suite():
+    return unittest.makeSuite(RpcMetricsTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+(c) 2009      ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import unittest
+import urllib2
+
+from tracrpc.msgpack_rpc import msgpack
+from tracrpc.tests import rpc_testenv, TracRpcTestCase
+
+class MsgpackTestCase(TracRpcTestCase):
+
+    def _auth_req(self, data, user='user',
+                  content_type='application/msgpack'):
+        password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        handler = urllib2.HTTPBasicAuthHandler(password_mgr)
+        password_mgr.add_password(realm=None,
+                      uri=rpc_testenv.url_auth,
+                      user=user,
+                      passwd=user)
+        req = urllib2.Request(rpc_testenv.url_auth,
+                    headers={'Content-Type': content_type},
+                    data=msgpack.packb(data))
+        resp = urllib2.build_opener(handler).open(req)
+        self.assertEquals(content_type, resp.info()['Content-Type'])
+        return msgpack.unpackb(resp.read(), raw=False)
+
+    def setUp(self):
+        TracRpcTestCase.setUp(self)
+
+    def tearDown(self):
+        TracRpcTestCase.tearDown(self)
+
+    def test_call(self):
+        for content_type in ('application/msgpack',
+                             'application/x-msgpack'):
+            result = self._auth_req({'method': 'system.listMethods',
+                                     'params': [], 'id': 244},
+                                    content_type=content_type)
+            self.assertTrue('system.methodHelp' in result['result'])
+            self.assertEquals(None, result['error'])
+            self.assertEquals(244, result['id'])
+
+    def test_multicall(self):
+        result = self._auth_req({'method': 'system.multicall', 'params': [
+                {'method': 'wiki.getAllPages', 'params': [], 'id': 1},
+                {'method': 'ticket.status.getAll', 'id': 2},
+                {'method': 'nonexisting', 'params': []}], 'id': 233})
+        items = result['result']
+        self.assertEquals([1, 2, 233], [item['id'] for item in items])
+        self.assertTrue('WikiStart' in items[0]['result'])
+        self.assertEquals(['accepted', 'assigned', 'closed', 'new',
+                           'reopened'], items[1]['result'])
+        self.assertEquals(-32601, items[2]['error']['code'])
+
+    def test_binary_and_datetime(self):
+        data = ''.join([chr(i) for i in range(256)]) * 1000
+        tid = self._auth_req({'method': 'ticket.create',
+                'params': ['msgpack', 'binary'], 'id': 1},
+                user='admin')['result']
+        try:
+            result = self._auth_req({'method': 'ticket.putAttachment',
+                    'params': [tid, 'data.bin', 'Data', data]},
+                    user='admin')
+            self.assertEquals('data.bin', result['result'])
+            result = self._auth_req({'method': 'ticket.getAttachment',
+                    'params': [tid, 'data.bin']})
+            self.assertEquals(data, result['result'])
+            created = self._auth_req({'method': 'ticket.get',
+                    'params': [tid]})['result'][1]
+            self.assertTrue(isinstance(created, msgpack.Timestamp))
+            result = self._auth_req({'method': 'ticket.getRecentChanges',
+                    'params': [created]})
+            self.assertTrue(tid in result['result'])
+        finally:
+            self._auth_req({'method': 'ticket.delete', 'params': [tid]},
+                           user='admin')
+
+    def test_str_params(self):
+        # Python 2 str is packed as bin by default: valid UTF-8 is text,
+        # unless the method signature expects binary data
+        result = self._auth_req({'method': 'wiki.getPage',
+                                 'params': ['WikiStart'], 'id': 1})
+        self.assertEquals(None, result['error'])
+        self.assertTrue(isinstance(result['result'], unicode))
+        tid = self._auth_req({'method': 'ticket.create',
+                'params': ['msgpack \xc3\xa5', 'text'], 'id': 1},
+                user='admin')['result']
+        try:
+            self.assertEquals(u'msgpack \xe5', self._auth_req({
+                    'method': 'ticket.get', 'params': [tid]}
+                    )['result'][3]['summary'])
+            self._auth_req({'method': 'ticket.putAttachment',
+                    'params': [tid, 'text.txt', 'Text', 'plain text']},
+                    user='admin')
+            result = self._auth_req({'method': 'ticket.getAttachment',
+                    'params': [tid, 'text.txt']})
+            self.assertEquals('plain text', result['result'])
+        finally:
+            self._auth_req({'method': 'ticket.delete', 'params': [tid]},
+                           user='admin')
+
+    def test_resource_not_found(self):
+        result = self._auth_req({'method': 'ticket.get',
+                'params': [2147483647], 'id': 3443})
+        self.assertEquals(3443, result['id'])
+        self.assertEquals(404, result['error']['code'])
+
+    def test_invalid_request(self):
+        result = self._auth_req([1, 2])
+        self.assertEquals(None, result['id'])
+        self.assertEquals(-32700, result['error']['code'])
+
+    def test_invalid_envelope(self):
+        for data in [{'method': 42, 'id': 1},
+                     {'params': ['WikiStart'], 'id': 1},
+                     {'method': 'wiki.getPage', 'params': 'WikiStart',
+                      'id': 1}]:
+            result = self._auth_req(data)
+            self.assertEquals(None, result['result'])
+            self.assertEquals(-32600, result['error']['code'])
+
+    def test_invalid_multicall(self):
+        for calls in [[1, 2], [{'params': []}],
+                      [{'method': 'wiki.getAllPages', 'params': {'a': 1}}],
+                      'wiki.getAllPages']:
+            result = self._auth_req({'method': 'system.multicall',
+                                     'params': calls, 'id': 2})
+            self.assertEquals(None, result['result'])
+            self.assertEquals(-32600, result['error']['code'])
+
+def test_suite():
+    if not msgpack:
+        # MessagePack-RPC not available
+        return unittest.TestSuite()
+    return unittest.makeSuite(MsgpackTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
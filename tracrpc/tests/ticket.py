@@ -36,6 +36,104 @@ class RpcTicketTestCase(TracRpcTestCase):
         self.assertEquals('admin', attributes['reporter'])
         self.admin.ticket.delete(tid)
 
+    def test_getMultiple(self):
+        tid1 = self.admin.ticket.create("getMultiple1", "one",
+                                        {'owner': 'A'})
+        tid2 = self.admin.ticket.create("getMultiple2", "two",
+                                        {'owner': 'B'})
+        try:
+            tickets = self.admin.ticket.getMultiple([tid2, 2147483647, tid1])
+            self.assertEquals(2, len(tickets))
+            self.assertEquals(self.admin.ticket.get(tid2), tickets[0])
+            self.assertEquals(self.admin.ticket.get(tid1), tickets[1])
+            tickets = self.admin.ticket.getMultiple([tid1],
+                                                    ['summary', 'owner'])
+            self.assertEquals({'summary': 'getMultiple1', 'owner': 'A',
+                               '_ts': tickets[0][3]['_ts']}, tickets[0][3])
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+
+    def test_createMultiple_updateMultiple(self):
+        results = self.admin.ticket.createMultiple([
+                    {'summary': 'createMultiple1', 'description': 'one'},
+                    {'description': 'no summary'},
+                    {'summary': 'createMultiple2', 'description': 'two',
+                     'attributes': {'owner': 'A'}}])
+        self.assertEquals(3, len(results))
+        tid1, tid2 = results[0]['id'], results[2]['id']
+        try:
+            self.assertEquals('', results[0]['error'])
+            self.assertEquals(0, results[1]['id'])
+            self.assertTrue(results[1]['error'])
+            self.assertEquals('A', self.admin.ticket.get(tid2)[3]['owner'])
+            results = self.admin.ticket.updateMultiple([
+                    {'id': tid1, 'comment': 'c1',
+                     'attributes': {'action': 'reassign',
+                                    'action_reassign_reassign_owner': 'B'}},
+                    {'id': tid2, 'comment': 'c2',
+                     'attributes': {'action': 'no_such_action'}},
+                    {'id': tid2, 'comment': 'c3',
+                     'attributes': {'action': 'leave', 'summary': 'S'}}])
+            self.assertEquals([tid1, tid2, tid2], [r['id'] for r in results])
+            self.assertEquals('', results[0]['error'])
+            self.assertTrue('invalid action' in results[1]['error'])
+            self.assertEquals('', results[2]['error'])
+            self.assertEquals('B', self.admin.ticket.get(tid1)[3]['owner'])
+            self.assertEquals('S', self.admin.ticket.get(tid2)[3]['summary'])
+            self.assertEquals('A', self.admin.ticket.get(tid2)[3]['owner'])
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+
+    def test_batch_invalid_item(self):
+        # Items that are not structs are reported, and the others saved
+        results = self.admin.ticket.createMultiple([
+                    'createMultiple3', {'summary': 'createMultiple3'}])
+        self.assertEquals(2, len(results))
+        tid = results[1]['id']
+        try:
+            self.assertEquals(0, results[0]['id'])
+            self.assertTrue('not a struct' in results[0]['error'])
+            self.assertEquals('', results[1]['error'])
+            results = self.admin.ticket.updateMultiple([[tid],
+                    {'id': tid, 'comment': 'c1',
+                     'attributes': {'action': 'leave', 'summary': 'S'}}])
+            self.assertEquals([0, tid], [r['id'] for r in results])
+            self.assertTrue('not a struct' in results[0]['error'])
+            self.assertEquals('S', self.admin.ticket.get(tid)[3]['summary'])
+        finally:
+            self.admin.ticket.delete(tid)
+
+    def test_async_notifications(self):
+        from tracrpc.util import db_query, run_in_transaction
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('rpc', 'async_notifications', 'true')
+        env.config.save()
+        rpc_testenv._tracadmin('upgrade')
+        rpc_testenv.restart()
+        tid = self.admin.ticket.create('async_notifications', '', {}, True)
+        try:
+            # Leased by a worker that died while sending: sent again
+            def insert_stale(db):
+                db.cursor().execute("INSERT INTO rpc_notify_spool "
+                        "(ticket,newticket,modtime,queued,attempts,claimed) "
+                        "VALUES (%s,1,NULL,1,1,1)", (tid,))
+            run_in_transaction(env, insert_stale)
+            self.admin.ticket.update(tid, 'comment', {}, True)
+            for i in range(10):
+                depth = list(db_query(env,
+                        "SELECT COUNT(*) FROM rpc_notify_spool"))[0][0]
+                if not depth:
+                    break
+                time.sleep(1)
+            self.assertEquals(0, depth)
+        finally:
+            self.admin.ticket.delete(tid)
+            env.config.remove('rpc', 'async_notifications')
+            env.config.save()
+            rpc_testenv.restart()
+
     def test_getActions(self):
         tid = self.admin.ticket.create("ticket_getActions", "kjsald",
                                         {'owner': ''})
@@ -163,6 +261,56 @@ class RpcTicketTestCase(TracRpcTestCase):
             self.admin.ticket.delete(tid1)
             self.admin.ticket.delete(tid2)
 
+    def test_getChangesSince(self):
+        batch = self.admin.ticket.getChangesSince('', 1000)
+        token = batch['token']
+        tid1 = self.admin.ticket.create("getChangesSince1", "one", {})
+        tid2 = self.admin.ticket.create("getChangesSince2", "two", {})
+        try:
+            time.sleep(1)
+            self.admin.ticket.update(tid1, "comment", {'summary': 'changed'})
+            batch = self.admin.ticket.getChangesSince(token, 1)
+            self.assertEquals(1, len(batch['tickets']))
+            self.assertEquals(tid2, batch['tickets'][0][0])
+            self.assertEquals([], batch['tickets'][0][4])
+            batch = self.admin.ticket.getChangesSince(batch['token'], 10)
+            self.assertEquals(1, len(batch['tickets']))
+            tid, created, changed, values, changes = batch['tickets'][0]
+            self.assertEquals(tid1, tid)
+            self.assertEquals('changed', values['summary'])
+            self.assertEquals(['comment', 'summary'],
+                              sorted([c[2] for c in changes]))
+            self.assertEquals([], self.admin.ticket.getChangesSince(
+                                        batch['token'], 10)['tickets'])
+            # Sync tokens are not query cursors, and vice versa
+            self.assertRaises(xmlrpclib.Fault, self.admin.ticket.queryCursor,
+                              "order=changetime", batch['token'], 1)
+            cursor = self.admin.ticket.queryCursor("order=changetime", "",
+                                                   1)['cursor']
+            self.assertRaises(xmlrpclib.Fault,
+                              self.admin.ticket.getChangesSince, cursor, 1)
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+
+    def test_changeLogMultiple(self):
+        tid1 = self.admin.ticket.create("changeLogMultiple1", "one", {})
+        tid2 = self.admin.ticket.create("changeLogMultiple2", "two", {})
+        try:
+            self.admin.ticket.update(tid1, "comment", {'summary': 'changed'})
+            logs = self.admin.ticket.changeLogMultiple([tid2, 2147483647,
+                                                        tid1])
+            # In the order of the given ids
+            self.assertEquals([tid2, tid1], [log[0] for log in logs])
+            self.assertEquals([], logs[0][1])
+            self.assertEquals(sorted(self.admin.ticket.changeLog(tid1)),
+                              sorted(logs[1][1]))
+            logs = self.admin.ticket.changeLogMultiple([tid1, tid2])
+            self.assertEquals([tid1, tid2], [log[0] for log in logs])
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+
     def test_query_group_order_col(self):
         t1 = self.admin.ticket.create("1", "",
                         {'type': 'enhancement', 'owner': 'A'})
@@ -188,6 +336,41 @@ class RpcTicketTestCase(TracRpcTestCase):
         self.assertEquals(0, self.admin.ticket.delete(t2))
         self.assertEquals(0, self.admin.ticket.delete(t3))
 
+    def test_queryFields(self):
+        t1 = self.admin.ticket.create("qf1", "", {'owner': 'A'})
+        t2 = self.admin.ticket.create("qf2", "", {'owner': 'B'})
+        try:
+            self.assertEquals(
+                [{'id': t2, 'summary': 'qf2', 'owner': 'B'},
+                 {'id': t1, 'summary': 'qf1', 'owner': 'A'}],
+                self.admin.ticket.queryFields("order=owner&desc=1&col=type",
+                                              ['summary', 'owner']))
+            self.assertRaises(xmlrpclib.Fault, self.admin.ticket.queryFields,
+                              "", ['summary', 'no_such_field'])
+        finally:
+            self.admin.ticket.delete(t1)
+            self.admin.ticket.delete(t2)
+
+    def test_queryCursor(self):
+        tids = [self.admin.ticket.create("qc%d" % i, "", {})
+                for i in range(5)]
+        try:
+            seen = []
+            batch = self.admin.ticket.queryCursor("summary^=qc", "", 2)
+            while True:
+                self.assertTrue(len(batch['ids']) <= 2)
+                seen.extend(batch['ids'])
+                if not batch['cursor']:
+                    break
+                batch = self.admin.ticket.queryCursor("summary^=qc",
+                                                      batch['cursor'], 2)
+            self.assertEquals(tids, seen)
+            self.assertRaises(xmlrpclib.Fault, self.admin.ticket.queryCursor,
+                              "order=time", 'aWQ6MTox', 2)
+        finally:
+            for tid in tids:
+                self.admin.ticket.delete(tid)
+
     def test_query_special_character_escape(self):
         # Note: This test only passes when using Trac 0.12+
         # See http://trac-hacks.org/ticket/7737
@@ -409,6 +592,72 @@ class RpcTicketTestCase(TracRpcTestCase):
         finally:
             self.admin.ticket.delete(tid1)
 
+    def test_checkbox_field(self):
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('ticket-custom', 'rpc_check', 'checkbox')
+        env.config.save()
+        rpc_testenv.restart()
+        try:
+            fields = dict([(f['name'], f)
+                           for f in self.admin.ticket.getTicketFields()])
+            self.assertEquals('checkbox', fields['rpc_check']['type'])
+            tid = self.admin.ticket.create('test_checkbox_field', '',
+                                           {'rpc_check': '1'})
+            self.assertEquals(True, self.admin.ticket.get(tid)[3]['rpc_check'])
+            self.admin.ticket.update(tid, '', {'action': 'leave',
+                                               'rpc_check': '0'})
+            self.assertEquals(False, self.admin.ticket.getMultiple([tid],
+                                    ['rpc_check'])[0][3]['rpc_check'])
+            self.admin.ticket.delete(tid)
+        finally:
+            env.config.remove('ticket-custom', 'rpc_check')
+            env.config.save()
+            rpc_testenv.restart()
+
+    def test_checkbox_field_unset(self):
+        # No value stored for fields added after the ticket was created:
+        # unchecked, as in Trac queries, whatever the default
+        tid = self.admin.ticket.create('test_checkbox_field_unset', '', {})
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('ticket-custom', 'rpc_unset', 'checkbox')
+        env.config.set('ticket-custom', 'rpc_unset.value', '1')
+        env.config.save()
+        rpc_testenv.restart()
+        try:
+            self.assertEquals(False,
+                    self.admin.ticket.get(tid)[3]['rpc_unset'])
+            self.assertEquals(False, self.admin.ticket.getMultiple([tid],
+                    ['rpc_unset'])[0][3]['rpc_unset'])
+            self.assertEquals([{'id': tid, 'rpc_unset': False}],
+                    self.admin.ticket.queryFields('id=%d' % tid,
+                                                  ['rpc_unset']))
+        finally:
+            self.admin.ticket.delete(tid)
+            env.config.remove('ticket-custom', 'rpc_unset')
+            env.config.remove('ticket-custom', 'rpc_unset.value')
+            env.config.save()
+            rpc_testenv.restart()
+
+    def test_getMultiple_missing_custom_value(self):
+        # Same attributes as get(), without defaults for a field added
+        # after the ticket was created
+        tid = self.admin.ticket.create('test_missing_custom_value', '', {})
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('ticket-custom', 'rpc_late', 'text')
+        env.config.set('ticket-custom', 'rpc_late.value', 'late-default')
+        env.config.save()
+        rpc_testenv.restart()
+        try:
+            ticket = self.admin.ticket.get(tid)
+            self.assertEquals([ticket], self.admin.ticket.getMultiple([tid]))
+            self.assertFalse('rpc_late' in ticket[3])
+        finally:
+            self.admin.ticket.delete(tid)
+            env.config.remove('ticket-custom', 'rpc_late')
+            env.config.remove('ticket-custom', 'rpc_late.value')
+            env.config.save()
+            rpc_testenv.restart()
+
 
 class RpcTicketVersionTestCase(TracRpcTestCase):
 
@@ -449,6 +698,21 @@ class RpcTicketTypeTestCase(TracRpcTestCase):
         self.assertEquals(['defect', 'enhancement', 'task'],
                 sorted(self.admin.ticket.type.getAll()))
 
+    def test_getTicketFields_updated(self):
+        def type_options():
+            for field in self.admin.ticket.getTicketFields():
+                if field['name'] == 'type':
+                    return field['options']
+        self.assertEquals(['defect', 'enhancement', 'task'],
+                          sorted(type_options()))
+        self.admin.ticket.type.create('rpc_type', '4')
+        try:
+            self.assertTrue('rpc_type' in type_options())
+        finally:
+            self.admin.ticket.type.delete('rpc_type')
+        self.assertEquals(['defect', 'enhancement', 'task'],
+                          sorted(type_options()))
+
 
 def test_suite():
     test_suite = unittest.TestSuite()
@@ -146,6 +146,156 @@ class RpcXmlTestCase(TracRpcTestCase):
         os.unlink(plugin)
         rpc_testenv.restart()
 
+    def test_large_binary(self):
+        # Larger than the read chunk size and the in-memory spool size
+        from tracrpc.xml_rpc import READ_CHUNK_SIZE, SPOOL_MAX_SIZE
+        data = ''.join([chr(i % 256) for i in range(256)]) \
+                    * (SPOOL_MAX_SIZE / 128 + READ_CHUNK_SIZE / 256 + 1)
+        tid = self.admin.ticket.create('large_binary', 'Line 1\nLine 2', {})
+        try:
+            self.assertEquals('Line 1\r\nLine 2',
+                              self.admin.ticket.get(tid)[3]['description'])
+            self.admin.ticket.putAttachment(tid, 'large.bin', 'Large',
+                                            xmlrpclib.Binary(data))
+            self.assertEquals(data,
+                self.admin.ticket.getAttachment(tid, 'large.bin').data)
+        finally:
+            self.admin.ticket.delete(tid)
+
+    def test_large_response(self):
+        # Streamed in several chunks, without Content-Length
+        from tracrpc.xml_rpc import WRITE_CHUNK_SIZE
+        text = u'R\xe9sum\xe9 \U0001D4C1 <&> ' \
+                    * (WRITE_CHUNK_SIZE / 8)
+        self.admin.wiki.putPage('LargeResponse', text, {})
+        try:
+            self.assertEquals(text, self.admin.wiki.getPage('LargeResponse'))
+        finally:
+            self.admin.wiki.deletePage('LargeResponse')
+
+    def test_compression(self):
+        # gzip encoded request body, and gzip encoded response
+        import gzip, urllib2
+        from StringIO import StringIO
+        body = StringIO()
+        f = gzip.GzipFile(fileobj=body, mode='wb')
+        f.write(xmlrpclib.dumps((), 'system.listMethods'))
+        f.close()
+        req = urllib2.Request(rpc_testenv.url_anon, body.getvalue(),
+                              {'Content-Type': 'application/xml',
+                               'Content-Encoding': 'gzip',
+                               'Accept-Encoding': 'gzip;q=1.0, deflate;q=0.5'})
+        resp = urllib2.urlopen(req)
+        self.assertEquals('gzip', resp.info().get('Content-Encoding'))
+        self.assertEquals('Accept-Encoding', resp.info().get('Vary'))
+        data = gzip.GzipFile(fileobj=StringIO(resp.read())).read()
+        methods = xmlrpclib.loads(data)[0][0]
+        self.assertTrue('system.listMethods' in methods)
+        # Not accepted by the client
+        req = urllib2.Request(rpc_testenv.url_anon, body.getvalue(),
+                              {'Content-Type': 'application/xml',
+                               'Content-Encoding': 'gzip'})
+        resp = urllib2.urlopen(req)
+        self.assertEquals(None, resp.info().get('Content-Encoding'))
+        self.assertEquals(methods, xmlrpclib.loads(resp.read())[0][0])
+
+    def test_max_decompressed_size(self):
+        import urllib2, zlib
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('rpc', 'max_decompressed_size', '4096')
+        env.config.save()
+        rpc_testenv.restart()
+        try:
+            headers = {'Content-Type': 'application/xml',
+                       'Content-Encoding': 'deflate'}
+            body = xmlrpclib.dumps(('x' * 1024 * 1024,), 'wiki.getPage')
+            e = self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                        urllib2.Request(rpc_testenv.url_anon,
+                                        zlib.compress(body), headers))
+            self.assertEquals(413, e.code)
+            # Small enough
+            body = xmlrpclib.dumps((), 'system.getAPIVersion')
+            resp = urllib2.urlopen(urllib2.Request(rpc_testenv.url_anon,
+                                        zlib.compress(body), headers))
+            self.assertTrue(xmlrpclib.loads(resp.read())[0][0])
+        finally:
+            env.config.remove('rpc', 'max_decompressed_size')
+            env.config.save()
+            rpc_testenv.restart()
+
+    def test_etag(self):
+        import urllib2
+        body = xmlrpclib.dumps((), 'system.listMethods')
+        headers = {'Content-Type': 'application/xml'}
+        resp = urllib2.urlopen(urllib2.Request(rpc_testenv.url_anon, body,
+                                               headers))
+        etag = resp.info().get('ETag')
+        self.assertTrue(etag.startswith('W/"'))
+        methods = xmlrpclib.loads(resp.read())[0][0]
+        # Unchanged result
+        headers['If-None-Match'] = etag
+        e = self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                    urllib2.Request(rpc_testenv.url_anon, body, headers))
+        self.assertEquals(304, e.code)
+        self.assertEquals(etag, e.info().get('ETag'))
+        # Other tag, or method without ETag support
+        headers['If-None-Match'] = 'W/"other", "tag"'
+        resp = urllib2.urlopen(urllib2.Request(rpc_testenv.url_anon, body,
+                                               headers))
+        self.assertEquals(methods, xmlrpclib.loads(resp.read())[0][0])
+        headers['If-None-Match'] = etag
+        resp = urllib2.urlopen(urllib2.Request(rpc_testenv.url_anon,
+                    xmlrpclib.dumps(('WikiStart',), 'wiki.getPage'), headers))
+        self.assertEquals(None, resp.info().get('ETag'))
+
+    def test_multicall_parallel(self):
+        env = rpc_testenv.get_trac_environment()
+        env.config.set('rpc', 'multicall_workers', '4')
+        env.config.save()
+        rpc_testenv.restart()
+        try:
+            tid = self.admin.ticket.create('multicall_parallel', 'one', {})
+            calls = [{'methodName': 'ticket.get', 'params': [tid]}] * 10
+            calls.append({'methodName': 'ticket.update',
+                          'params': [tid, 'comment', {'summary': 'two'}]})
+            calls.extend([{'methodName': 'ticket.get', 'params': [tid]},
+                          {'methodName': 'wiki.getPage',
+                           'params': ['WikiStart']}])
+            result = self.admin.system.multicall(calls)
+            self.assertEquals(13, len(result))
+            for item in result[:10]:
+                self.assertEquals('one', item[0][3]['summary'])
+            self.assertEquals('two', result[10][0][3]['summary'])
+            self.assertEquals('two', result[11][0][3]['summary'])
+            self.assertTrue('Welcome' in result[12][0])
+            self.admin.ticket.delete(tid)
+        finally:
+            env.config.remove('rpc', 'multicall_workers')
+            env.config.save()
+            rpc_testenv.restart()
+
+    def test_multicall_atomic(self):
+        tid = self.admin.ticket.create('multicall_atomic', 'one', {})
+        try:
+            # All calls succeed
+            result = self.admin.system.multicallAtomic([
+                {'methodName': 'ticket.update',
+                 'params': [tid, 'c1', {'summary': 'two'}]},
+                {'methodName': 'ticket.get', 'params': [tid]}])
+            self.assertEquals(2, len(result))
+            self.assertEquals('two', result[1][0][3]['summary'])
+            # Last call fails, first update is rolled back
+            e = self.assertRaises(xmlrpclib.Fault,
+                    self.admin.system.multicallAtomic, [
+                {'methodName': 'ticket.update',
+                 'params': [tid, 'c2', {'summary': 'three'}]},
+                {'methodName': 'ticket.get', 'params': [2147483647]}])
+            self.assertTrue('Call 1 (ticket.get) failed' in e.faultString)
+            self.assertEquals('two', self.admin.ticket.get(tid)[3]['summary'])
+            self.assertEquals(2, len(self.admin.ticket.changeLog(tid)))
+        finally:
+            self.admin.ticket.delete(tid)
+
 def test_suite():
     return unittest.makeSuite(RpcXmlTestCase)
 
@@ -8,6 +8,7 @@ License: BSD
 
 import inspect
 from datetime import datetime
+import threading
 
 import genshi
 
@@ -24,26 +25,61 @@ from trac.web.chrome import add_warning
 from trac.util.datefmt import to_datetime, utc
 from trac.util.text import to_unicode
 
-from tracrpc.api import IXMLRPCHandler, expose_rpc, Binary
-from tracrpc.util import StringIO, to_utimestamp, from_utimestamp
+from tracrpc.api import IXMLRPCHandler, expose_rpc, read_only, Binary
+from tracrpc.notification import NotificationQueue
+from tracrpc.util import to_utimestamp, from_utimestamp, \
+                         call_after_commit, chunks, db_query, empty, \
+                         filter_resources, exception_to_unicode, \
+                         has_transactions, run_atomic
 
 __all__ = ['TicketRPC']
 
+def checkbox_value(value):
+    """ Value of a checkbox field as a boolean. As for Trac queries, a
+    ticket without value (`None` or empty) is unchecked, whatever the
+    default value of the field. """
+    return value not in (None, '', '0', 0)
+
+class FieldMetadata(object):
+    """ Lookup tables for a list of ticket fields (as returned by
+    `TicketSystem.get_ticket_fields()`): `types` mapping names to field
+    types, `checkbox` and `time` sets of names, `custom` names, and `std`
+    names of the other fields stored in the `ticket` table. """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.types = dict([(f['name'], f['type']) for f in fields])
+        self.checkbox = set([f['name'] for f in fields
+                             if f['type'] == 'checkbox'])
+        self.time = set([f['name'] for f in fields if f['type'] == 'time'])
+        self.custom = [f['name'] for f in fields if f.get('custom')]
+        self.std = [f['name'] for f in fields if not f.get('custom')
+                    and f['name'] not in ('time', 'changetime')]
+
 class TicketRPC(Component):
     """ An interface to Trac's ticketing system. """
 
     implements(IXMLRPCHandler)
 
+    def __init__(self):
+        self._fields_lock = threading.Lock()
+        self._fields_meta = None
+
     # IXMLRPCHandler methods
     def xmlrpc_namespace(self):
         return 'ticket'
 
     def xmlrpc_methods(self):
         yield (None, ((list,), (list, str)), self.query)
+        yield (None, ((list, str, list),), self.queryFields)
+        yield (None, ((dict, str), (dict, str, str), (dict, str, str, int)),
+                      self.queryCursor)
         yield (None, ((list, datetime),), self.getRecentChanges)
+        yield (None, ((dict, str), (dict, str, int)), self.getChangesSince)
         yield (None, ((list, int),), self.getAvailableActions)
         yield (None, ((list, int),), self.getActions)
         yield (None, ((list, int),), self.get)
+        yield (None, ((list, list), (list, list, list)), self.getMultiple)
         yield ('TICKET_CREATE', ((int, str, str),
                                  (int, str, str, dict),
                                  (int, str, str, dict, bool),
@@ -55,8 +91,15 @@ class TicketRPC(Component):
                       (list, int, str, dict, bool, str),
                       (list, int, str, dict, bool, str, datetime)),
                       self.update)
+        if has_transactions(self.env):
+            yield ('TICKET_CREATE', ((list, list), (list, list, bool)),
+                          self.createMultiple)
+            yield (None, ((list, list), (list, list, bool)),
+                          self.updateMultiple)
         yield (None, ((None, int),), self.delete)
         yield (None, ((dict, int), (dict, int, int)), self.changeLog)
+        yield (None, ((list, list), (list, list, datetime)),
+                      self.changeLogMultiple)
         yield (None, ((list, int),), self.listAttachments)
         yield (None, ((Binary, int, str),), self.getAttachment)
         yield (None,
@@ -67,6 +110,7 @@ class TicketRPC(Component):
         yield ('TICKET_VIEW', ((list,),), self.getTicketFields)
 
     # Exported methods
+    @read_only
     def query(self, req, qstr='status!=closed'):
         """
         Perform a ticket query, returning a list of ticket ID's.
@@ -77,13 +121,97 @@ class TicketRPC(Component):
         """
         q = query.Query.from_string(self.env, qstr)
         ticket_realm = Resource('ticket')
+        return [t['id'] for t in filter_resources(self.env, req,
+                        'TICKET_VIEW', q.execute(req),
+                        lambda t: ticket_realm(id=t['id']))]
+
+    @read_only
+    def queryFields(self, req, qstr, fields):
+        """
+        Perform a ticket query like `query()`, but return a list of structs
+        with the given `fields` (and `id`) for each ticket, instead of ID's.
+        Paging works as for `query()`, and any `col=` arguments in the query
+        string are replaced by `fields`.
+        """
+        meta = self._field_meta()
+        unknown = [name for name in fields
+                   if name != 'id' and name not in meta.types]
+        if unknown:
+            raise TracError("Unknown ticket field(s): %s"
+                            % ', '.join(unknown))
+        checkbox_fields = meta.checkbox
+        columns = ['id'] + [name for name in fields if name != 'id']
+        q = query.Query.from_string(self.env, qstr)
+        q.cols = list(columns)
+        ticket_realm = Resource('ticket')
         out = []
-        for t in q.execute(req):
-            tid = t['id']
-            if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid)):
-                out.append(tid)
+        for t in filter_resources(self.env, req, 'TICKET_VIEW',
+                        q.execute(req), lambda t: ticket_realm(id=t['id'])):
+            values = {}
+            for name in columns:
+                value = t.get(name)
+                if name in checkbox_fields:
+                    value = checkbox_value(value)
+                values[name] = value
+            out.append(values)
         return out
 
+    @read_only
+    def queryCursor(self, req, qstr='status!=closed', cursor='', limit=1000):
+        """
+        Perform a ticket query, returning one batch of at most `limit`
+        ticket ID's as a struct `{'ids': [...], 'cursor': <str>}`. Pass the
+        returned `cursor` to the next call (with the same query) to get the
+        next batch; an empty `cursor` means there are no more results.
+        Fetching any batch costs the same as fetching the first one.
+        Results are ordered by `id` (default), `time` or `changetime` as
+        given by `order=` in the query, always ascending. Paging (`max`,
+        `page`), grouping and `desc` arguments are ignored.
+        """
+        q = query.Query.from_string(self.env, qstr)
+        order = q.order in ('time', 'changetime') and q.order or 'id'
+        q.order, q.desc, q.group = order, 0, None
+        limit = max(1, min(int(limit), 10000))
+        sql, args = q.get_sql(req)
+        sql = 'SELECT id,%s FROM (%s) AS q' % (order, sql)
+        args = list(args)
+        if cursor:
+            key, last_id = self._decode_position('cursor', cursor, order)
+            sql += ' WHERE %s>%%s OR (%s=%%s AND id>%%s)' % (order, order)
+            args.extend([key, key, last_id])
+        sql += ' ORDER BY %s,id LIMIT %%s' % order
+        args.append(limit)
+        rows = list(db_query(self.env, sql, args))
+        ticket_realm = Resource('ticket')
+        ids = [tid for tid, key in filter_resources(self.env, req,
+                    'TICKET_VIEW', rows, lambda row: ticket_realm(id=row[0]))]
+        next_cursor = ''
+        if len(rows) == limit:
+            next_cursor = self._encode_position('cursor', order,
+                                                rows[-1][1], rows[-1][0])
+        return {'ids': ids, 'cursor': next_cursor}
+
+    def _encode_position(self, kind, order, key, last_id):
+        """ Encode the position after ticket `last_id` with `order` column
+        value `key`, as returned by `queryCursor()` (`kind` 'cursor') and
+        `getChangesSince()` (`kind` 'token'). """
+        position = '%s:%s:%s:%s' % (kind, order, key, last_id)
+        return position.encode('base64').replace('\n', '')
+
+    def _decode_position(self, kind, position, order):
+        """ Return the `(key, last_id)` encoded by `_encode_position()`.
+        Values of another `kind` or `order` are rejected. """
+        try:
+            p_kind, p_order, key, last_id = \
+                    str(position).decode('base64').split(':')
+            if (p_kind, p_order) != (kind, order):
+                raise ValueError(p_kind, p_order)
+            return long(key), int(last_id)
+        except Exception:
+            raise TracError("Invalid %s %r for tickets ordered by %s"
+                            % (kind, position, order))
+
+    @read_only
     def getRecentChanges(self, req, since):
         """Returns a list of IDs of tickets that have changed since timestamp."""
         since = to_utimestamp(since)
@@ -95,19 +223,52 @@ class TicketRPC(Component):
             cursor = db.cursor()
             cursor.execute(query, (since,))
             generator = cursor        
-        result = []
         ticket_realm = Resource('ticket')
-        for row in generator:
-            tid = int(row[0])
-            if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid)):
-                result.append(tid)
-        return result
-
+        return list(filter_resources(self.env, req, 'TICKET_VIEW',
+                                     [int(row[0]) for row in generator],
+                                     lambda tid: ticket_realm(id=tid)))
+
+    @read_only
+    def getChangesSince(self, req, token='', limit=100):
+        """Returns a batch of at most `limit` tickets changed after `token`,
+        ordered by change time, as a struct
+        `{'tickets': [...], 'token': <str>}`. Each ticket is a
+        `[id, time_created, time_changed, attributes, changes]` list, where
+        the first four elements are as returned by `get()` and `changes` is
+        a list of `[time, author, field, oldvalue, newvalue, permanent]`
+        changes made after `token`. Pass the returned `token` to the next
+        call to continue; use an empty token to start from the beginning.
+        Deleted tickets are not reported."""
+        limit = max(1, min(int(limit), 1000))
+        key, last_id = 0, 0
+        if token:
+            key, last_id = self._decode_position('token', token,
+                                                 'changetime')
+        rows = list(db_query(self.env,
+                'SELECT id,changetime FROM ticket '
+                'WHERE changetime>%s OR (changetime=%s AND id>%s) '
+                'ORDER BY changetime,id LIMIT %s',
+                (key, key, last_id, limit)))
+        if not rows:
+            return {'tickets': [], 'token': token}
+        changes = self._get_changes([tid for tid, changed in rows], key)
+        tickets = []
+        for ticket in self.getMultiple(req, [tid for tid, changed in rows]):
+            tid = ticket[0]
+            tickets.append(list(ticket) + [[c[1:]
+                                for c in changes.get(tid, [])
+                                if c[0] > key or tid > last_id]])
+        return {'tickets': tickets,
+                'token': self._encode_position('token', 'changetime',
+                                               rows[-1][1], rows[-1][0])}
+
+    @read_only
     def getAvailableActions(self, req, id):
         """ Deprecated - will be removed. Replaced by `getActions()`. """
         self.log.warning("Rpc ticket.getAvailableActions is deprecated")
         return [action[0] for action in self.getActions(req, id)]
 
+    @read_only
     def getActions(self, req, id):
         """Returns the actions that can be performed on the ticket as a list of
         `[action, label, hints, [input_fields]]` elements, where `input_fields` is
@@ -149,29 +310,116 @@ class TicketRPC(Component):
             actions.append((action, first_label, " ".join(hints), controls))
         return actions
 
+    @read_only
     def get(self, req, id):
         """ Fetch a ticket. Returns [id, time_created, time_changed, attributes]. """
         self.log.debug("RPC(xml) Fetch ticket with ID %s", id)
         t = model.Ticket(self.env, id)
         req.perm(t.resource).require('TICKET_VIEW')
         t['_ts'] = str(to_utimestamp(t.time_changed))
-        ts = TicketSystem(self.env)
-        all_fields = {}
-        for field in ts.get_ticket_fields():
-            all_fields[field['name']] = field['type']
-        self.log.debug("RPC(xml) ticket fields: %s" % (repr(all_fields)))
+        meta = self._field_meta()
         field_values = t.values
-        for k, v in field_values.iteritems():
-            if k in all_fields and all_fields[k] == 'checkbox':
-                if v == '0' or v == 0:
-                    field_values[k] = False
-                else:
-                    field_values[k] = True
+        for name in meta.checkbox:
+            field_values[name] = checkbox_value(field_values.get(name))
         return (t.id, t.time_created, t.time_changed, field_values)
 
+    @read_only
+    def getMultiple(self, req, ids, fields=None):
+        """ Fetch many tickets at once. Returns a list with an
+        `[id, time_created, time_changed, attributes]` element (as for
+        `get()`) for each ticket. Optional `fields` restricts `attributes`
+        to the given field names (`_ts` is always included). Tickets that
+        do not exist or that the user may not view are left out. """
+        ids = [int(tid) for tid in ids]
+        meta = self._field_meta()
+        std_fields, custom_fields = meta.std, meta.custom
+        time_fields, checkbox_fields = meta.time, meta.checkbox
+        if fields is not None:
+            fields = set(fields)
+            std_fields = [name for name in std_fields if name in fields]
+            custom_fields = [name for name in custom_fields if name in fields]
+            time_fields = time_fields & fields
+            checkbox_fields = checkbox_fields & fields
+        # Values are read as by `model.Ticket`: custom fields without a
+        # `ticket_custom` row are left out, NULL values are `empty`
+        null_value = empty
+        if null_value is None:
+            null_value = ''
+        tickets = {}
+        for batch in chunks(set(ids)):
+            in_ids = ','.join(['%s'] * len(batch))
+            for row in db_query(self.env,
+                    'SELECT id,time,changetime%s FROM ticket WHERE id IN (%s)'
+                    % (''.join([',' + f for f in std_fields]), in_ids),
+                    batch):
+                tid, created, changed = row[:3]
+                values = {}
+                for name, value in zip(std_fields, row[3:]):
+                    if value is None:
+                        value = null_value
+                    values[name] = value
+                time_created = from_utimestamp(created)
+                time_changed = from_utimestamp(changed)
+                if 'time' in time_fields:
+                    values['time'] = time_created
+                if 'changetime' in time_fields:
+                    values['changetime'] = time_changed
+                values['_ts'] = str(changed)
+                tickets[tid] = [tid, time_created, time_changed, values]
+            if not custom_fields or not tickets:
+                continue
+            for tid, name, value in db_query(self.env,
+                    'SELECT ticket,name,value FROM ticket_custom '
+                    'WHERE ticket IN (%s) AND name IN (%s)' % (in_ids,
+                            ','.join(['%s'] * len(custom_fields))),
+                    batch + custom_fields):
+                if tid not in tickets:
+                    continue
+                if value is None:
+                    value = null_value
+                elif name in time_fields and value:
+                    try:
+                        value = from_utimestamp(long(value))
+                    except ValueError:
+                        pass
+                tickets[tid][3][name] = value
+        for values in [t[3] for t in tickets.itervalues()]:
+            for name in checkbox_fields:
+                values[name] = checkbox_value(values.get(name))
+        ticket_realm = Resource('ticket')
+        result = []
+        for tid in filter_resources(self.env, req, 'TICKET_VIEW',
+                        [tid for tid in ids if tid in tickets],
+                        lambda tid: ticket_realm(id=tid)):
+            ticket = tickets.pop(tid, None)
+            if ticket is not None:
+                result.append(tuple(ticket))
+        return result
+
     def create(self, req, summary, description, attributes={}, notify=False, when=None):
         """ Create a new ticket, returning the ticket ID.
         Overriding 'when' requires admin permission. """
+        t = self._prepare_create(req, summary, description, attributes, when)()
+        if notify:
+            self._queue_notification(req, t, True)
+        return t.id
+
+    def createMultiple(self, req, tickets, notify=False):
+        """ Create many tickets in a single transaction. `tickets` is a list
+        of `{'summary': str, 'description': str, 'attributes': dict}` structs
+        (`attributes` and `when` are optional, as for `create()`). Returns a
+        `{'id': int, 'error': str}` struct for each ticket, with `id` 0 and
+        a non-empty `error` for tickets that could not be created. Database
+        errors abort the whole batch. Requires Trac 0.12 or higher. """
+        def prepare(item):
+            return self._prepare_create(req, item['summary'],
+                        item.get('description', ''),
+                        item.get('attributes') or {}, item.get('when'))
+        return self._run_batch(req, tickets, prepare, notify, True)
+
+    def _prepare_create(self, req, summary, description, attributes, when):
+        """ Check and set up a new ticket, and return a function that
+        inserts the ticket and returns it. """
         t = model.Ticket(self.env)
         t['summary'] = summary
         t['description'] = description
@@ -185,15 +433,10 @@ class TicketRPC(Component):
             self.log.warn("RPC ticket.create: %r not allowed to create with "
                     "non-current timestamp (%r)", req.authname, when)
             when = None
-        t.insert(when=when)
-        if notify:
-            try:
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(t, newticket=True)
-            except Exception, e:
-                self.log.exception("Failure sending notification on creation "
-                                   "of ticket #%s: %s" % (t.id, e))
-        return t.id
+        def insert():
+            t.insert(when=when)
+            return t
+        return insert
 
     def update(self, req, id, comment, attributes={}, notify=False, author='', when=None):
         """ Update a ticket, returning the new ticket in the same form as
@@ -204,6 +447,31 @@ class TicketRPC(Component):
         from get() or update() calls).
         ''Calling update without 'action' and '_ts' changetime token is
         deprecated, and will raise errors in a future version.'' """
+        t, when = self._prepare_update(req, id, comment, attributes,
+                                       author, when)()
+        if notify:
+            self._queue_notification(req, t, False, when)
+        return self.get(req, t.id)
+
+    def updateMultiple(self, req, tickets, notify=False):
+        """ Update many tickets in a single transaction. `tickets` is a list
+        of `{'id': int, 'comment': str, 'attributes': dict}` structs
+        (`attributes`, `author` and `when` are optional, as for `update()`).
+        Returns a `{'id': int, 'error': str}` struct for each ticket, with a
+        non-empty `error` for tickets that could not be updated. Database
+        errors abort the whole batch. Requires Trac 0.12 or higher. """
+        meta = self._field_meta()
+        def prepare(item):
+            return self._prepare_update(req, int(item['id']),
+                        item.get('comment', ''),
+                        item.get('attributes') or {}, item.get('author', ''),
+                        item.get('when'), meta)
+        return self._run_batch(req, tickets, prepare, notify, False)
+
+    def _prepare_update(self, req, id, comment, attributes, author, when,
+                        meta=None):
+        """ Check an update of a ticket, and return a function that saves
+        the changes and returns a `(ticket, time_changed)` tuple. """
         t = model.Ticket(self.env, id)
         # custom author?
         if author and not (req.authname == 'anonymous' \
@@ -236,56 +504,105 @@ class TicketRPC(Component):
                 raise TracError("Ticket has been updated since last get().")
             for k, v in attributes.iteritems():
                 t[k] = v
+            def save():
+                t.save_changes(author, comment, when=when)
+                return t, when
+            return save
+        ts = TicketSystem(self.env)
+        tm = TicketModule(self.env)
+        # TODO: Deprecate update without time_changed timestamp
+        time_changed = attributes.pop('_ts', to_utimestamp(t.time_changed))
+        try:
+            time_changed = int(time_changed)
+        except ValueError:
+            raise TracError("RPC ticket.update: Wrong '_ts' token " \
+                            "in attributes (%r)." % time_changed)
+        action = attributes.get('action')
+        avail_actions = ts.get_available_actions(req, t)
+        if not action in avail_actions:
+            raise TracError("Rpc: Ticket %d by %s " \
+                    "invalid action '%s'" % (id, req.authname, action))
+        controllers = list(tm._get_action_controllers(req, t, action))
+        if meta is None:
+            meta = self._field_meta()
+        for k, v in attributes.iteritems():
+            if k in meta.types and k != 'status':
+                t[k] = v
+        # TicketModule reads req.args - need to move things there...
+        req.args.update(attributes)
+        req.args['comment'] = comment
+        # Collision detection: 0.11+0.12 timestamp
+        req.args['ts'] = str(from_utimestamp(time_changed))
+        # Collision detection: 0.13/1.0+ timestamp
+        req.args['view_time'] = str(time_changed)
+        changes, problems = tm.get_ticket_changes(req, t, action)
+        for warning in problems:
+            add_warning(req, "Rpc ticket.update: %s" % warning)
+        valid = problems and False or tm._validate_ticket(req, t)
+        if not valid:
+            raise TracError(
+                " ".join([warning for warning in req.chrome['warnings']]))
+        def save():
+            tm._apply_ticket_changes(t, changes)
+            self.log.debug("Rpc ticket.update save: %s" % repr(t.values))
             t.save_changes(author, comment, when=when)
+            # Apply workflow side-effects
+            for controller in controllers:
+                controller.apply_action_side_effects(req, t, action)
+            return t, when
+        return save
+
+    def _run_batch(self, req, items, prepare, notify, newticket):
+        """ Prepare and save each item in turn, in a single transaction.
+        Errors raised while preparing an item are reported for that item,
+        while errors raised when saving abort and roll back the batch. """
+        args = dict(req.args)
+        def do_batch(db):
+            results = []
+            for idx, item in enumerate(items):
+                # Start each item from the same request state
+                req.args.clear()
+                req.args.update(args)
+                if 'warnings' in req.chrome:
+                    del req.chrome['warnings'][:]
+                try:
+                    if not isinstance(item, dict):
+                        raise TracError("Ticket %d is not a struct" % idx)
+                    save = prepare(item)
+                except Exception, e:
+                    self.log.info("RPC ticket batch item %d rejected: %s",
+                                  idx, exception_to_unicode(e))
+                    results.append({'id': isinstance(item, dict)
+                                          and item.get('id', 0) or 0,
+                                    'error': to_unicode(e)})
+                    continue
+                saved = save()
+                t, when = newticket and (saved, None) or saved
+                if notify:
+                    self._queue_notification(req, t, newticket, when)
+                results.append({'id': t.id, 'error': ''})
+            return results
+        try:
+            return run_atomic(self.env, req, do_batch)
+        finally:
+            req.args.clear()
+            req.args.update(args)
+
+    def _queue_notification(self, req, t, newticket, modtime=None):
+        queue = NotificationQueue(self.env)
+        if queue.enabled:
+            queue.enqueue(req, t.id, newticket, modtime)
         else:
-            ts = TicketSystem(self.env)
-            tm = TicketModule(self.env)
-            # TODO: Deprecate update without time_changed timestamp
-            time_changed = attributes.pop('_ts', to_utimestamp(t.time_changed))
-            try:
-                time_changed = int(time_changed)
-            except ValueError:
-                raise TracError("RPC ticket.update: Wrong '_ts' token " \
-                                "in attributes (%r)." % time_changed)
-            action = attributes.get('action')
-            avail_actions = ts.get_available_actions(req, t)
-            if not action in avail_actions:
-                raise TracError("Rpc: Ticket %d by %s " \
-                        "invalid action '%s'" % (id, req.authname, action))
-            controllers = list(tm._get_action_controllers(req, t, action))
-            all_fields = [field['name'] for field in ts.get_ticket_fields()]
-            for k, v in attributes.iteritems():
-                if k in all_fields and k != 'status':
-                    t[k] = v
-            # TicketModule reads req.args - need to move things there...
-            req.args.update(attributes)
-            req.args['comment'] = comment
-            # Collision detection: 0.11+0.12 timestamp
-            req.args['ts'] = str(from_utimestamp(time_changed))
-            # Collision detection: 0.13/1.0+ timestamp
-            req.args['view_time'] = str(time_changed)
-            changes, problems = tm.get_ticket_changes(req, t, action)
-            for warning in problems:
-                add_warning(req, "Rpc ticket.update: %s" % warning)
-            valid = problems and False or tm._validate_ticket(req, t)
-            if not valid:
-                raise TracError(
-                    " ".join([warning for warning in req.chrome['warnings']]))
-            else:
-                tm._apply_ticket_changes(t, changes)
-                self.log.debug("Rpc ticket.update save: %s" % repr(t.values))
-                t.save_changes(author, comment, when=when)
-                # Apply workflow side-effects
-                for controller in controllers:
-                    controller.apply_action_side_effects(req, t, action)
-        if notify:
-            try:
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(t, newticket=False, modtime=when)
-            except Exception, e:
-                self.log.exception("Failure sending notification on change of "
-                                   "ticket #%s: %s" % (t.id, e))
-        return self.get(req, t.id)
+            call_after_commit(req, self._notify, t, newticket, modtime)
+
+    def _notify(self, t, newticket, modtime=None):
+        try:
+            tn = TicketNotifyEmail(self.env)
+            tn.notify(t, newticket=newticket, modtime=modtime)
+        except Exception, e:
+            self.log.exception("Failure sending notification on %s of "
+                               "ticket #%s: %s" % (newticket and 'creation'
+                                            or 'change', t.id, e))
 
     def delete(self, req, id):
         """ Delete ticket with the given id. """
@@ -293,6 +610,7 @@ class TicketRPC(Component):
         req.perm(t.resource).require('TICKET_ADMIN')
         t.delete()
 
+    @read_only
     def changeLog(self, req, id, when=0):
         t = model.Ticket(self.env, id)
         req.perm(t.resource).require('TICKET_VIEW')
@@ -301,14 +619,71 @@ class TicketRPC(Component):
     # Use existing documentation from Ticket model
     changeLog.__doc__ = inspect.getdoc(model.Ticket.get_changelog)
 
+    @read_only
+    def changeLogMultiple(self, req, ids, since=0):
+        """ Return the changelogs of many tickets as a list of
+        `[id, changes]` pairs in the order of `ids`, where `changes` is a
+        list in the same form as `changeLog()`. Only changes made at or
+        after the optional `since` time are included. Tickets that do not
+        exist or that the user may not view are left out. """
+        if since:
+            since = to_utimestamp(since)
+        ticket_realm = Resource('ticket')
+        ids = [int(tid) for tid in ids]
+        existing = set()
+        for batch in chunks(set(ids)):
+            existing.update([row[0] for row in db_query(self.env,
+                    'SELECT id FROM ticket WHERE id IN (%s)'
+                    % ','.join(['%s'] * len(batch)), batch)])
+        ids = list(filter_resources(self.env, req, 'TICKET_VIEW',
+                        [tid for tid in ids if tid in existing],
+                        lambda tid: ticket_realm(id=tid)))
+        changes = self._get_changes(ids, since, attachments=True)
+        return [[tid, [c[1:] for c in changes.get(tid, [])]]
+                for tid in ids]
+
+    def _get_changes(self, ids, since=0, attachments=False):
+        """Return a `{id: [(utimestamp, time, author, field, oldvalue,
+        newvalue, permanent), ...]}` dictionary of `ticket_change` rows at
+        or after `since` (a timestamp as stored), ordered by time. With
+        `attachments`, attachments are included as for
+        `Ticket.get_changelog()`."""
+        changes = {}
+        for batch in chunks(ids):
+            in_ids = ','.join(['%s'] * len(batch))
+            for tid, when, author, field, old, new in db_query(self.env,
+                    'SELECT ticket,time,author,field,oldvalue,newvalue '
+                    'FROM ticket_change WHERE ticket IN (%s) AND time>=%%s '
+                    'ORDER BY ticket,time,field' % in_ids, batch + [since]):
+                changes.setdefault(tid, []).append((when,
+                        from_utimestamp(when), author, field, old, new, 1))
+            if not attachments:
+                continue
+            for tid, when, author, filename, description in db_query(
+                    self.env, 'SELECT id,time,author,filename,description '
+                    'FROM attachment WHERE type=%%s AND id IN (%s) '
+                    'AND time>=%%s' % in_ids,
+                    ['ticket'] + [str(tid) for tid in batch] + [since]):
+                entries = changes.setdefault(int(tid), [])
+                entries.append((when, from_utimestamp(when), author,
+                                'attachment', None, filename, 0))
+                entries.append((when, from_utimestamp(when), author,
+                                'comment', None, description, 0))
+        if attachments:
+            for entries in changes.itervalues():
+                entries.sort(key=lambda c: (c[0], c[6], c[2]))
+        return changes
+
+    @read_only
     def listAttachments(self, req, ticket):
         """ Lists attachments for a given ticket. Returns (filename,
         description, size, time, author) for each attachment."""
-        attachments = []
-        for a in Attachment.select(self.env, 'ticket', ticket):
-            if 'ATTACHMENT_VIEW' in req.perm(a.resource):
-                yield (a.filename, a.description, a.size, a.date, a.author)
+        for a in filter_resources(self.env, req, 'ATTACHMENT_VIEW',
+                        Attachment.select(self.env, 'ticket', ticket),
+                        lambda a: a.resource):
+            yield (a.filename, a.description, a.size, a.date, a.author)
 
+    @read_only
     def getAttachment(self, req, ticket, filename):
         """ returns the content of an attachment. """
         attachment = Attachment(self.env, 'ticket', ticket, filename)
@@ -331,7 +706,7 @@ class TicketRPC(Component):
         req.perm(attachment.resource).require('ATTACHMENT_CREATE')
         attachment.author = req.authname
         attachment.description = description
-        attachment.insert(filename, StringIO(data.data), len(data.data))
+        attachment.insert(filename, data.open(), data.size())
         return attachment.filename
 
     def deleteAttachment(self, req, ticket, filename):
@@ -343,10 +718,32 @@ class TicketRPC(Component):
         attachment.delete()
         return True
 
+    @read_only
     def getTicketFields(self, req):
         """ Return a list of all ticket fields fields. """
         return TicketSystem(self.env).get_ticket_fields()
 
+    # Internal methods
+
+    def _field_meta(self):
+        """ Return the `FieldMetadata` of the ticket fields. It is built
+        from the ticket fields cached by `TicketSystem`, and rebuilt when
+        Trac invalidates that cache (changes to the configuration, or to
+        the enum, milestone, component or version tables). Without such a
+        cache (Trac 0.11), it is built for each call. """
+        ts = TicketSystem(self.env)
+        fields = getattr(ts, 'fields', None)
+        if fields is None:
+            return FieldMetadata(ts.get_ticket_fields())
+        self._fields_lock.acquire()
+        try:
+            meta = self._fields_meta
+            if meta is None or meta.fields is not fields:
+                meta = self._fields_meta = FieldMetadata(fields)
+            return meta
+        finally:
+            self._fields_lock.release()
+
 class StatusRPC(Component):
     """ An interface to Trac ticket status objects.
     Note: Status is defined by workflow, and all methods except `getAll()`
@@ -365,10 +762,12 @@ class StatusRPC(Component):
         yield ('TICKET_ADMIN', ((None, str, dict),), self.create)
         yield ('TICKET_ADMIN', ((None, str, dict),), self.update)
 
+    @read_only
     def getAll(self, req):
         """ Returns all ticket states described by active workflow. """
         return TicketSystem(self.env).get_all_status()
     
+    @read_only
     def get(self, req, name):
         """ Deprecated no-op method. Do not use. """
         # FIXME: Remove
@@ -404,11 +803,13 @@ def ticketModelFactory(cls, cls_attributes):
             yield ('TICKET_ADMIN', ((None, str, dict),), self.create)
             yield ('TICKET_ADMIN', ((None, str, dict),), self.update)
 
+        @read_only
         def getAll(self, req):
             for i in cls.select(self.env):
                 yield i.name
         getAll.__doc__ = """ Get a list of all ticket %s names. """ % cls.__name__.lower()
 
+        @read_only
         def get(self, req, name):
             i = cls(self.env, name)
             attributes= {}
@@ -460,11 +861,13 @@ def ticketEnumFactory(cls):
             yield ('TICKET_ADMIN', ((None, str, str),), self.create)
             yield ('TICKET_ADMIN', ((None, str, str),), self.update)
 
+        @read_only
         def getAll(self, req):
             for i in cls.select(self.env):
                 yield i.name
         getAll.__doc__ = """ Get a list of all ticket %s names. """ % cls.__name__.lower()
 
+        @read_only
         def get(self, req, name):
             if (cls.__name__ == 'Status'):
                i = cls(self.env)
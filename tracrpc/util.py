@@ -6,7 +6,11 @@ License: BSD
 (c) 2009-2013 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
+import logging
+from repr import Repr
 import sys
+import xmlrpclib
+import zlib
 
 # Supported Python versions:
 PY24 = sys.version_info[:2] == (2, 4)
@@ -14,13 +18,21 @@ PY25 = sys.version_info[:2] == (2, 5)
 PY26 = sys.version_info[:2] == (2, 6)
 PY27 = sys.version_info[:2] == (2, 7)
 
+from trac.core import TracError
 from trac.util.compat import any
+from trac.util.text import to_unicode
+from trac.web.api import HTTPRequestEntityTooLarge
 
 try:
   from cStringIO import StringIO
 except ImportError:
   from StringIO import StringIO
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
 try:
     # Method only available in Trac 0.11.3 or higher
     from trac.util.text import exception_to_unicode
@@ -52,6 +64,382 @@ def accepts_mimetype(req, mimetype):
         accept = accept.split(',')
         return any(x.strip().startswith(y) for x in accept for y in mimetype)
 
+def content_etag(*values):
+    """Return a weak entity tag for a response made of `values`, computed
+    from their content (the items of dictionaries in key order)."""
+    digest = md5()
+    def update(value):
+        if isinstance(value, dict):
+            digest.update('{')
+            for key in sorted(value):
+                update(key)
+                update(value[key])
+            digest.update('}')
+        elif isinstance(value, (list, tuple)):
+            digest.update('[')
+            for item in value:
+                update(item)
+            digest.update(']')
+        elif isinstance(value, xmlrpclib.Binary):
+            digest.update('b%d:' % len(value.data))
+            digest.update(value.data)
+        else:
+            if not isinstance(value, (basestring, int, long, float, bool,
+                                      type(None))):
+                value = to_unicode(value)
+            text = repr(value)
+            digest.update('%s%d:%s' % (type(value).__name__, len(text), text))
+    for value in values:
+        update(value)
+    return 'W/"%s"' % digest.hexdigest()
+
+def if_none_match(req, etag):
+    """Return `True` if `etag` matches the `If-None-Match` header of the
+    request (using the weak comparison)."""
+    header = req.get_header('If-None-Match')
+    if not header:
+        return False
+    def opaque(tag):
+        tag = tag.strip()
+        return tag.startswith('W/') and tag[2:] or tag
+    return any(tag.strip() == '*' or opaque(tag) == opaque(etag)
+               for tag in header.split(','))
+
+def db_query(env, query, args=()):
+    """Execute a read-only query, and return an iterable of rows."""
+    if hasattr(env, 'db_query'):
+        return env.db_query(query, args)
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    cursor.execute(query, args)
+    return cursor
+
+def chunks(items, size=500):
+    """Split a sequence into lists of at most `size` items, for instance
+    to keep `IN (...)` queries below database parameter limits."""
+    items = list(items)
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+# Policies whose decisions depend on user and action, but not on the
+# specific resource (attachments are decided by the parent realm)
+_RESOURCE_INDEPENDENT_POLICIES = ('DefaultPermissionPolicy',
+                                  'LegacyAttachmentPolicy')
+
+def filter_resources(env, req, action, items, resource=None):
+    """Yield the `items` for which `req` is granted `action`.
+
+    `resource` is an optional function returning the `Resource` for an item
+    (by default the items are resources). When all permission policies
+    in use decide without looking at the specific resource (Trac's default
+    policies), the decision is made once per realm. Otherwise each distinct
+    resource is checked once: fine-grained policies (`AuthzPolicy`, private
+    tickets) may deny a resource even if the realm is granted."""
+    from trac.perm import PermissionSystem
+    policies = PermissionSystem(env).policies
+    per_realm = not [p for p in policies if p.__class__.__name__
+                     not in _RESOURCE_INDEPENDENT_POLICIES]
+    decisions = {}
+    for item in items:
+        res = resource and resource(item) or item
+        if per_realm:
+            key = (res.realm, res.parent and res.parent.realm)
+        else:
+            key = res
+        allowed = decisions.get(key)
+        if allowed is None:
+            allowed = decisions[key] = action in req.perm(res)
+        if allowed:
+            yield item
+
+try:
+    # Trac 0.12 and 1.0
+    from trac.db.api import with_transaction
+except ImportError:
+    with_transaction = None
+
+def has_transactions(env):
+    """Return `True` if `run_in_transaction()` is supported (Trac 0.12 or
+    higher). Methods relying on it are not exposed otherwise."""
+    return with_transaction is not None or hasattr(env, 'db_transaction')
+
+def run_in_transaction(env, func):
+    """Call `func(db)` inside a single database transaction, and return its
+    result. Changes are committed when `func` returns, and rolled back if it
+    raises. Transactions started by code called from `func` join this one.
+    Requires Trac 0.12 or higher (see `has_transactions()`)."""
+    if hasattr(env, 'db_transaction'):
+        # Trac 1.0+
+        mgr = env.db_transaction
+        db = mgr.__enter__()
+        try:
+            result = func(db)
+        except:
+            if not mgr.__exit__(*sys.exc_info()):
+                raise
+        else:
+            mgr.__exit__(None, None, None)
+            return result
+    if with_transaction is None:
+        raise TracError("Transactions require Trac 0.12 or higher")
+    result = []
+    @with_transaction(env)
+    def do_transaction(db):
+        result.append(func(db))
+    return result[0]
+
+def run_atomic(env, req, func):
+    """Call `func(db)` in a single transaction like `run_in_transaction()`,
+    deferring calls made through `call_after_commit(req, ...)` until the
+    transaction has been committed. Nested calls join the outer
+    transaction, and their deferred calls wait for the outer commit."""
+    if getattr(req, '_rpc_after_commit', None) is not None:
+        return func(None)
+    req._rpc_after_commit = deferred = []
+    try:
+        result = run_in_transaction(env, func)
+    finally:
+        del req._rpc_after_commit
+    for f, args, kwargs in deferred:
+        f(*args, **kwargs)
+    return result
+
+def call_after_commit(req, func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` once the transaction of the current
+    atomic RPC call (see `run_atomic()`) has been committed, or
+    right away if the request has no such transaction. Deferred calls are
+    dropped if the transaction is rolled back."""
+    deferred = getattr(req, '_rpc_after_commit', None)
+    if deferred is None:
+        func(*args, **kwargs)
+    else:
+        deferred.append((func, args, kwargs))
+
+class _PayloadRepr(Repr):
+    """`repr()` that abbreviates long strings, sequences and binaries."""
+
+    def __init__(self, limit):
+        Repr.__init__(self)
+        self.maxlevel = 4
+        self.maxlist = self.maxtuple = self.maxdict = 20
+        self.maxstring = self.maxlong = self.maxother = limit
+
+    def repr_unicode(self, x, level):
+        return self.repr_str(x, level)
+
+    def repr_instance(self, x, level):
+        if isinstance(x, xmlrpclib.Binary):
+            return '<Binary %d bytes>' % (hasattr(x, 'size') and x.size()
+                                          or len(x.data or ''))
+        return Repr.repr_instance(self, x, level)
+
+class PayloadRepr(object):
+    """Wraps a request or response payload for logging: the `repr()` is
+    only computed when the message is actually formatted, and is truncated
+    to `limit` characters without first building the full `repr()`."""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = _PayloadRepr(self.limit).repr(self.value)
+        if len(text) > self.limit:
+            text = text[:self.limit] + '...'
+        return text
+
+def log_payload(log, limit, message, *args):
+    """Log `message` at debug level, the last of `args` being a request or
+    response payload that is formatted using `PayloadRepr`. Nothing is done
+    if `limit` is 0 or debug logging is disabled."""
+    if limit > 0 and log.isEnabledFor(logging.DEBUG):
+        log.debug(message, *(args[:-1] + (PayloadRepr(args[-1], limit),)))
+
+def accepted_encoding(req):
+    """Return the content coding (`'gzip'` or `'deflate'`) preferred by the
+    client according to its `Accept-Encoding` header, or `None`."""
+    accepted = {}
+    for item in (req.get_header('Accept-Encoding') or '').split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, value = (param.split('=', 1) + [''])[:2]
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        accepted[coding == 'x-gzip' and 'gzip' or coding] = q
+    best, best_q = None, 0
+    for coding in ('gzip', 'deflate'):
+        q = accepted.get(coding, accepted.get('*', 0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def _compressor(coding, level):
+    if coding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+class RequestBody(object):
+    """File-like object reading the body of a request up to its
+    `Content-Length`, and decoding it according to its `Content-Encoding`
+    (gzip or deflate). Data is decompressed at most `chunk_size` bytes at a
+    time, and `HTTPRequestEntityTooLarge` is raised when the decompressed
+    body exceeds the `_rpc_max_decompressed_size` attribute of the request
+    (see `RPCWeb`)."""
+
+    def __init__(self, req, chunk_size=64 * 1024):
+        self._req = req
+        self._chunk_size = chunk_size
+        self._remaining = int(req.get_header('Content-Length'))
+        coding = (req.get_header('Content-Encoding') or 'identity') \
+                        .strip().lower()
+        if coding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif coding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        elif coding == 'identity':
+            self._decompressor = None
+        else:
+            raise ValueError("Unsupported Content-Encoding: %s" % coding)
+        self._max_size = getattr(req, '_rpc_max_decompressed_size', 0)
+        self._size = 0
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        """Read at most `size` bytes (all if negative). An empty string is
+        returned at the end of the body."""
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(self._chunk_size), ''))
+        while not self._buffer and not self._eof:
+            self._fill()
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def _fill(self):
+        decompressor = self._decompressor
+        if decompressor is not None and decompressor.unconsumed_tail:
+            # Input left over by the previous call
+            data = decompressor.unconsumed_tail
+        else:
+            data = ''
+            if self._remaining > 0:
+                data = self._req.read(min(self._remaining, self._chunk_size))
+                self._remaining -= len(data)
+            if not data:
+                self._eof = True
+        if decompressor is not None:
+            if self._eof:
+                data = decompressor.flush()
+            else:
+                data = decompressor.decompress(data, self._chunk_size)
+            self._size += len(data)
+            if self._max_size > 0 and self._size > self._max_size:
+                raise HTTPRequestEntityTooLarge("Decompressed request body "
+                        "larger than %d bytes" % self._max_size)
+        self._buffer = data
+
+class ResponseStream(object):
+    """Writes a response body in UTF-8 encoded chunks of `chunk_size`
+    characters, optionally passing each chunk of text through `sanitize`.
+    With `encoding=None`, the body is written as given (bytes). A body that
+    fits in a single chunk is sent with a `Content-Length`;
+    larger bodies are sent without, and the server frames them (chunked
+    transfer encoding, or closing the connection).
+
+    If the request has a `_rpc_compression` attribute (a `(level,
+    min_size)` tuple, see `RPCWeb`) and the client accepts it, bodies of at
+    least `min_size` bytes are compressed with gzip or deflate. An
+    `_rpc_etag` attribute (a string, or a function returning it) is sent
+    as `ETag` header."""
+
+    def __init__(self, req, content_type, chunk_size=64 * 1024,
+                 sanitize=None, encoding='utf-8'):
+        self.started = False
+        self._req = req
+        self._content_type = content_type
+        self._chunk_size = chunk_size
+        self._sanitize = sanitize
+        self._encoding = encoding
+        self._join = encoding and u''.join or ''.join
+        self._buffer = []
+        self._buffered = 0
+        self._compression = getattr(req, '_rpc_compression', None)
+        self._etag = getattr(req, '_rpc_etag', None)
+        self._compressor = None
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self._chunk_size:
+            text = self._join(self._buffer)
+            # Don't split a surrogate pair (narrow Python builds)
+            if self._encoding and u'\ud800' <= text[-1] <= u'\udbff':
+                self._buffer = [text[-1]]
+                text = text[:-1]
+            else:
+                self._buffer = []
+            self._buffered = len(self._buffer)
+            data = self._encode(text)
+            if not self.started:
+                self._start(len(data), False)
+            if self._compressor is not None:
+                data = self._compressor.compress(data)
+            self._req.write(data)
+
+    def close(self):
+        """Write the remaining text."""
+        data = self._encode(self._join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        if not self.started:
+            data = self._start(len(data), True, data)
+        elif self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush()
+        self._req.write(data)
+
+    def _start(self, size, complete, data=None):
+        """Send the headers. `size` is the size of the first chunk, or of
+        the whole body (given as `data`) if `complete`. Returns `data`,
+        compressed if needed."""
+        self.started = True
+        req = self._req
+        coding = None
+        if self._compression and size >= self._compression[1]:
+            coding = accepted_encoding(req)
+        if coding:
+            self._compressor = _compressor(coding, self._compression[0])
+            if complete:
+                data = self._compressor.compress(data) \
+                       + self._compressor.flush()
+        req.send_response(200)
+        req.send_header('Content-Type', self._content_type)
+        if coding:
+            req.send_header('Content-Encoding', coding)
+        if self._compression:
+            req.send_header('Vary', 'Accept-Encoding')
+        if callable(self._etag):
+            self._etag = self._etag()
+        if self._etag:
+            req.send_header('ETag', self._etag)
+        if complete:
+            req.send_header('Content-Length', len(data))
+        req.end_headers()
+        return data
+
+    def _encode(self, text):
+        if self._sanitize is not None:
+            text = self._sanitize(text)
+        if self._encoding:
+            text = text.encode(self._encoding)
+        return text
+
 def prepare_docs(text, indent=4):
     r"""Remove leading whitespace"""
     return text and ''.join(l[indent:] for l in text.splitlines(True)) or ''
@@ -15,13 +15,14 @@ from genshi.builder import tag
 from genshi.template.base import TemplateSyntaxError, BadDirectiveError
 from genshi.template.text import TextTemplate
 
+from trac.config import IntOption, ListOption
 from trac.core import *
 from trac.perm import PermissionError
 from trac.resource import ResourceNotFound
 from trac.util.text import to_unicode
 from trac.util.translation import _
 from trac.web.api import RequestDone, HTTPUnsupportedMediaType, \
-                          HTTPInternalError
+                          HTTPInternalError, HTTPRequestEntityTooLarge
 from trac.web.main import IRequestHandler
 from trac.web.chrome import ITemplateProvider, INavigationContributor, \
                             add_stylesheet, add_script, add_ctxtnav
@@ -29,7 +30,10 @@ from trac.wiki.formatter import wiki_to_oneliner
 
 from tracrpc.api import XMLRPCSystem, IRPCProtocol, ProtocolException, \
                           RPCError, ServiceException
-from tracrpc.util import accepts_mimetype, exception_to_unicode
+from tracrpc.metrics import PHASES, RPCMetrics, summarize
+from tracrpc.notification import NotificationQueue
+from tracrpc.util import accepts_mimetype, content_etag, \
+                         exception_to_unicode, if_none_match
 
 __all__ = ['RPCWeb']
 
@@ -42,11 +46,43 @@ class RPCWeb(Component):
 
     protocols = ExtensionPoint(IRPCProtocol)
 
+    slow_call_ms = IntOption('rpc', 'slow_call_ms', 0,
+        """Log a warning with method, user, argument sizes, time spent per
+        phase, database query count and response size for RPC calls
+        taking longer than this many milliseconds. `0` disables the
+        slow-call log. Counting queries wraps the methods of Trac's database
+        cursors while calls are handled.""")
+
+    compression_level = IntOption('rpc', 'compression_level', 6,
+        """zlib compression level (1-9) of RPC responses sent gzip or
+        deflate encoded to clients accepting it (`Accept-Encoding`).
+        `0` disables response compression.""")
+
+    compression_min_size = IntOption('rpc', 'compression_min_size', 1024,
+        """Minimum size in bytes of RPC responses to compress. Responses
+        too large to be sent at once are always compressed.""")
+
+    max_decompressed_size = IntOption('rpc', 'max_decompressed_size',
+        64 * 1024 * 1024,
+        """Maximum size in bytes of gzip or deflate encoded request bodies
+        once decompressed. Larger requests are rejected with
+        `413 Request Entity Too Large`. `0` removes the limit.""")
+
+    etag_methods = ListOption('rpc', 'etag_methods',
+        'ticket.getTicketFields, ticket.status.getAll, '
+        'ticket.milestone.getAll, wiki.getAllPages, system.listMethods',
+        doc="""Read-only methods whose results are sent with an `ETag`
+        computed from their content. Clients repeating the call with the
+        tag in an `If-None-Match` header get a `304 Not Modified` response
+        when the result is unchanged.""")
+
     # IRequestHandler methods
 
     def match_request(self, req):
         """ Look for available protocols serving at requested path and
             content-type. """
+        if req.path_info in ('/rpc/metrics', '/login/rpc/metrics'):
+            return True
         content_type = req.get_header('Content-Type') or 'text/html'
         must_handle_request = req.path_info in ('/rpc', '/login/rpc')
         for protocol in self.protocols:
@@ -60,6 +96,8 @@ class RPCWeb(Component):
         return must_handle_request
 
     def process_request(self, req):
+        if req.path_info.endswith('/rpc/metrics'):
+            return self._send_metrics(req)
         protocol = req.args.get('protocol', None)
         content_type = req.get_header('Content-Type') or 'text/html'
         if protocol:
@@ -122,6 +160,27 @@ class RPCWeb(Component):
                  },
                 None)
 
+    def _send_metrics(self, req):
+        """ Send RPC statistics in Prometheus text format. """
+        req.perm.require('RPC_METRICS_VIEW')
+        extra = []
+        queue = NotificationQueue(self.env)
+        if queue.enabled:
+            stats = queue.stats()
+            for name, type, help in (
+                    ('queued', 'counter', 'Notifications queued.'),
+                    ('sent', 'counter', 'Notifications sent.'),
+                    ('failed', 'counter', 'Notifications given up on.'),
+                    ('depth', 'gauge', 'Notifications waiting to be sent.'),
+                    ('latency_avg', 'gauge',
+                     'Average seconds from queueing to sending.'),
+                    ('latency_max', 'gauge',
+                     'Maximum seconds from queueing to sending.')):
+                extra.append(('tracrpc_notifications_' + name, type, help,
+                              stats[name]))
+        body = RPCMetrics(self.env).render_prometheus(extra)
+        req.send(body.encode('utf-8'), 'text/plain; version=0.0.4', 200)
+
     def _expand_docs(self, docs, ctx):
         try :
             tmpl = TextTemplate(docs)
@@ -137,15 +196,32 @@ class RPCWeb(Component):
     def _rpc_process(self, req, protocol, content_type):
         """Process incoming RPC request and finalize response."""
         proto_id = protocol.rpc_info()[0]
-        rpcreq = req.rpc = {'mimetype': content_type}
+        req.rpc = {'mimetype': content_type}
+        req._rpc_max_decompressed_size = self.max_decompressed_size
+        if self.compression_level > 0:
+            req._rpc_compression = (min(self.compression_level, 9),
+                                    self.compression_min_size)
+        slow_call_ms = self.slow_call_ms
+        recorder = RPCMetrics(self.env).recorder(req, proto_id,
+                                                 count_queries=slow_call_ms > 0)
+        try:
+            self._rpc_call(req, protocol, content_type, proto_id, recorder)
+        finally:
+            recorder.finish()
+            if slow_call_ms > 0 and recorder.elapsed * 1000 >= slow_call_ms:
+                self._log_slow_call(req, proto_id, recorder)
+
+    def _rpc_call(self, req, protocol, content_type, proto_id, recorder):
         try :
             self.log.debug("RPC(%s) call by '%s'", proto_id, req.authname)
+            recorder.phase('parse')
             rpcreq = req.rpc = protocol.parse_rpc_request(req, content_type)
             rpcreq['mimetype'] = content_type
 
             # Important ! Check after parsing RPC request to add 
             #             protocol-specific fields in response 
             #             (e.g. JSON-RPC response `id`)
+            recorder.phase('permission')
             req.perm.require('XML_RPC') # Need at least XML_RPC
 
             method_name = rpcreq.get('method')
@@ -154,8 +230,12 @@ class RPCWeb(Component):
             args = rpcreq.get('params') or []
             self.log.debug("RPC(%s) call by '%s' %s", proto_id, \
                                               req.authname, method_name)
+            method = XMLRPCSystem(self.env).get_method(method_name)
+            recorder.method = method_name
+            method.check_permission(req)
+            recorder.phase('execute')
             try :
-                result = (XMLRPCSystem(self.env).get_method(method_name)(req, args))[0]
+                result = method(req, args)[0]
                 if isinstance(result, GeneratorType):
                     result = list(result)
             except (TracError, PermissionError, ResourceNotFound), e:
@@ -168,10 +248,18 @@ class RPCWeb(Component):
                                exception_to_unicode(e, traceback=True))
                 raise ServiceException(e), None, tb
             else :
+                recorder.phase('serialize')
+                if method_name in self.etag_methods:
+                    self._check_etag(req, proto_id, result)
                 protocol.send_rpc_result(req, result)
         except RequestDone :
             raise
+        except HTTPRequestEntityTooLarge:
+            recorder.error = True
+            raise
         except (TracError, PermissionError, ResourceNotFound), e:
+            recorder.error = True
+            recorder.phase('serialize')
             if type(e) is not ServiceException:
                 self.log.warning("RPC(%s) [%s] %s", proto_id, req.remote_addr,
                                  exception_to_unicode(e))
@@ -183,9 +271,43 @@ class RPCWeb(Component):
                 self.log.exception("RPC(%s) Unhandled protocol error", proto_id)
                 self._send_unknown_error(req, e)
         except Exception, e :
+            recorder.error = True
             self.log.exception("RPC(%s) Unhandled protocol error", proto_id)
             self._send_unknown_error(req, e)
 
+    def _check_etag(self, req, proto_id, result):
+        """ Send `304 Not Modified` if the client already has `result`,
+        else tag the response. The tag covers the protocol and request id,
+        which are part of the response body. Without `If-None-Match`
+        header, the tag is only computed when the response is sent. """
+        rpcreq = req.rpc
+        def etag():
+            return content_etag(proto_id, rpcreq['mimetype'],
+                                rpcreq.get('id'), result)
+        if not req.get_header('If-None-Match'):
+            req._rpc_etag = etag
+            return
+        req._rpc_etag = etag = etag()
+        if if_none_match(req, etag):
+            RPCMetrics(self.env).count(proto_id, 'not_modified')
+            req.send_response(304)
+            req.send_header('ETag', etag)
+            req.end_headers()
+            raise RequestDone
+
+    def _log_slow_call(self, req, proto_id, recorder):
+        """ Log a call that took longer than `[rpc] slow_call_ms`. Only
+        the sizes of arguments are logged, not their content. """
+        params = (req.rpc or {}).get('params') or []
+        self.log.warning("RPC(%s) slow call: method=%s user=%s elapsed_ms=%d "
+                "args=[%s] phases_ms={%s} queries=%s response_bytes=%d "
+                "error=%s", proto_id, recorder.method or '(undefined)',
+                req.authname, recorder.elapsed * 1000,
+                ', '.join([summarize(arg) for arg in params]),
+                ', '.join(['%s: %d' % (phase, recorder.timings[phase] * 1000)
+                           for phase in PHASES if phase in recorder.timings]),
+                recorder.queries, recorder.response_size, recorder.error)
+
     def _send_unknown_error(self, req, e):
         """Last recourse if protocol cannot handle the RPC request | error"""
         method_name = req.rpc and req.rpc.get('method') or '(undefined)'
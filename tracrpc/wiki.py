@@ -17,8 +17,8 @@ from trac.wiki.api import WikiSystem, IWikiPageManipulator
 from trac.wiki.model import WikiPage
 from trac.wiki.formatter import wiki_to_html, format_to_html
 
-from tracrpc.api import IXMLRPCHandler, expose_rpc, Binary
-from tracrpc.util import StringIO, to_utimestamp, from_utimestamp
+from tracrpc.api import IXMLRPCHandler, expose_rpc, read_only, Binary
+from tracrpc.util import to_utimestamp, from_utimestamp, filter_resources
 
 __all__ = ['WikiRPC']
 
@@ -74,6 +74,7 @@ class WikiRPC(Component):
         return dict(name=name, lastModified=when,
                     author=author, version=int(version), comment=comment)
 
+    @read_only
     def getRecentChanges(self, req, since):
         """ Get list of changed pages since timestamp """
         since = to_utimestamp(since)
@@ -93,22 +94,25 @@ class WikiRPC(Component):
             cursor.execute(query, (since,))
             generator = cursor
         result = []
-        for name, when, author, version, comment in generator:
-            if 'WIKI_VIEW' in req.perm(wiki_realm(id=name, version=version)):
-                result.append(
-                    self._page_info(name, from_utimestamp(when),
-                                    author, version, comment))
+        for name, when, author, version, comment in filter_resources(
+                    self.env, req, 'WIKI_VIEW', generator,
+                    lambda row: wiki_realm(id=row[0], version=row[3])):
+            result.append(self._page_info(name, from_utimestamp(when),
+                                          author, version, comment))
         return result
 
+    @read_only
     def getRPCVersionSupported(self, req):
         """ Returns 2 with this version of the Trac API. """
         return 2
 
+    @read_only
     def getPage(self, req, pagename, version=None):
         """ Get the raw Wiki text of page, latest version. """
         page = self._fetch_page(req, pagename, version)
         return page.text
 
+    @read_only
     def getPageHTML(self, req, pagename, version=None):
         """ Return latest version of page as rendered HTML, utf8 encoded. """
         page = self._fetch_page(req, pagename, version)
@@ -119,14 +123,15 @@ class WikiRPC(Component):
         html = format_to_html(self.env, context, fields['text'])
         return '<html><body>%s</body></html>' % html.encode('utf-8')
 
+    @read_only
     def getAllPages(self, req):
         """ Returns a list of all pages. The result is an array of utf8 pagenames. """
-        pages = []
-        for page in self.wiki.get_pages():
-            if 'WIKI_VIEW' in req.perm(Resource('wiki', page)):
-                pages.append(page)
-        return pages
+        wiki_realm = Resource('wiki')
+        return list(filter_resources(self.env, req, 'WIKI_VIEW',
+                                     self.wiki.get_pages(),
+                                     lambda page: wiki_realm(id=page)))
 
+    @read_only
     def getPageInfo(self, req, pagename, version=None):
         """ Returns information about the given page. """
         page = WikiPage(self.env, pagename, version)
@@ -166,12 +171,15 @@ class WikiRPC(Component):
         except:
             return False
 
+    @read_only
     def listAttachments(self, req, pagename):
         """ Lists attachments on a given page. """
-        for a in Attachment.select(self.env, 'wiki', pagename):
-            if 'ATTACHMENT_VIEW' in req.perm(a.resource):
-                yield pagename + '/' + a.filename
+        for a in filter_resources(self.env, req, 'ATTACHMENT_VIEW',
+                        Attachment.select(self.env, 'wiki', pagename),
+                        lambda a: a.resource):
+            yield pagename + '/' + a.filename
 
+    @read_only
     def getAttachment(self, req, path):
         """ returns the content of an attachment. """
         pagename, filename = os.path.split(path)
@@ -206,7 +214,7 @@ class WikiRPC(Component):
         req.perm(attachment.resource).require('ATTACHMENT_CREATE')
         attachment.author = req.authname
         attachment.description = description
-        attachment.insert(filename, StringIO(data.data), len(data.data))
+        attachment.insert(filename, data.open(), data.size())
         return attachment.filename
 
     def deleteAttachment(self, req, path):
@@ -219,10 +227,12 @@ class WikiRPC(Component):
         attachment.delete()
         return True
 
+    @read_only
     def listLinks(self, req, pagename):
         """ ''Not implemented'' """
         return []
 
+    @read_only
     def wikiToHtml(self, req, text):
         """ Render arbitrary Wiki text as HTML. """
         return unicode(wiki_to_html(text, self.env, req, absurls=1))
@@ -6,10 +6,12 @@ License: BSD
 (c) 2009      ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
+import base64
 import datetime
 import re
 import sys
 import time
+from xml.parsers import expat
 import xmlrpclib
 
 try:
@@ -23,11 +25,20 @@ from trac.perm import PermissionError
 from trac.resource import ResourceNotFound
 from trac.util.datefmt import utc
 from trac.util.text import to_unicode
-from trac.web.api import RequestDone
+from trac.web.api import HTTPRequestEntityTooLarge, RequestDone
 
-from tracrpc.api import XMLRPCSystem, IRPCProtocol, Binary, \
-        RPCError, MethodNotFound, ProtocolException, ServiceException
-from tracrpc.util import empty, prepare_docs
+from tracrpc.api import XMLRPCSystem, IRPCProtocol, Binary, SpooledBinary, \
+        RPCError, MethodNotFound, ProtocolException, ServiceException, \
+        MULTICALL_METHODS
+from tracrpc.metrics import RPCMetrics
+from tracrpc.util import RequestBody, ResponseStream, StringIO, empty, \
+                         log_payload, prepare_docs
+
+try:
+    from tempfile import SpooledTemporaryFile
+except ImportError: # Python < 2.6
+    def SpooledTemporaryFile(max_size=0):
+        return StringIO()
 
 __all__ = ['XmlRpcProtocol']
 
@@ -50,6 +61,10 @@ _illegal_ranges = ["%s-%s" % (unichr(low), unichr(high))
 
 _illegal_xml_chars_RE = re.compile(u'[%s]' % u''.join(_illegal_ranges))
 
+READ_CHUNK_SIZE = 64 * 1024     # Bytes read from the request at a time
+WRITE_CHUNK_SIZE = 64 * 1024    # Characters written to the response at a time
+SPOOL_MAX_SIZE = 1024 * 1024    # Binary values kept in memory up to this size
+
 def to_xmlrpc_datetime(dt):
     """ Convert a datetime.datetime object to a xmlrpclib DateTime object """
     return xmlrpclib.DateTime(dt.utctimetuple())
@@ -59,6 +74,231 @@ def from_xmlrpc_datetime(data):
     t = list(time.strptime(data.value, "%Y%m%dT%H:%M:%S")[0:6])
     return apply(datetime.datetime, t, {'tzinfo': utc})
 
+class RequestParser(object):
+    """ Incremental parser for XML-RPC `methodCall` documents. Data is
+    fed in chunks, and the arguments are normalized while parsing:
+     1. `dateTime.iso8601` values are converted to Python datetime (UTC)
+     2. `base64` values are decoded into a spooled temporary file, and
+        returned as `tracrpc.api.SpooledBinary`
+     3. String line-endings same as from web (`\n` => `\r\n`), and
+        `'true'`/`'false'` strings converted to `'1'`/`'0'`
+    """
+
+    def __init__(self):
+        self.method = None
+        self._values = []
+        self._marks = []
+        self._data = []
+        self._value = False
+        self._b64 = None
+        self._parser = parser = expat.ParserCreate()
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._char_data
+        parser.buffer_text = True
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        """ Finish parsing, and return a `(method, params)` tuple. """
+        self._parser.Parse('', True)
+        if self._marks:
+            raise ValueError("Unterminated array or struct")
+        return self.method, self._values
+
+    # Expat handlers
+
+    def _start(self, tag, attrs):
+        if tag in ('array', 'struct'):
+            self._marks.append(len(self._values))
+        elif tag == 'base64':
+            self._b64 = ['', SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE), 0]
+        self._data = []
+        self._value = tag == 'value'
+
+    def _char_data(self, text):
+        if self._b64 is None:
+            self._data.append(text)
+            return
+        # Decode complete groups of 4 characters, keep the rest for later
+        pending = self._b64[0] + ''.join(str(text).split())
+        complete = len(pending) - len(pending) % 4
+        if complete:
+            data = base64.decodestring(pending[:complete])
+            self._b64[1].write(data)
+            self._b64[2] += len(data)
+        self._b64[0] = pending[complete:]
+
+    def _end(self, tag):
+        text = u''.join(self._data)
+        self._data = []
+        if tag == 'value':
+            if self._value: # No type element means string
+                self._values.append(self._string(text))
+            self._value = False
+        elif tag == 'string':
+            self._values.append(self._string(text))
+        elif tag in ('int', 'i4', 'i8'):
+            self._values.append(int(text))
+        elif tag == 'boolean':
+            if text not in ('0', '1'):
+                raise TypeError("Bad boolean value: %r" % text)
+            self._values.append(text == '1')
+        elif tag == 'double':
+            self._values.append(float(text))
+        elif tag == 'dateTime.iso8601':
+            self._values.append(from_xmlrpc_datetime(
+                                xmlrpclib.DateTime(str(text.strip()))))
+        elif tag == 'base64':
+            pending, fileobj, size = self._b64
+            self._b64 = None
+            if pending:
+                data = base64.decodestring(pending)
+                fileobj.write(data)
+                size += len(data)
+            self._values.append(SpooledBinary(fileobj, size))
+        elif tag == 'nil':
+            self._values.append(None)
+        elif tag == 'name':
+            self._values.append(_stringify(text))
+        elif tag == 'array':
+            mark = self._marks.pop()
+            self._values[mark:] = [self._values[mark:]]
+        elif tag == 'struct':
+            mark = self._marks.pop()
+            items = self._values[mark:]
+            self._values[mark:] = [dict(zip(items[::2], items[1::2]))]
+        elif tag == 'methodName':
+            self.method = _stringify(text)
+
+    def _string(self, text):
+        if text == 'false':
+            return '0'
+        elif text == 'true':
+            return '1'
+        return _stringify(text.replace('\n', '\r\n'))
+
+class ResponseWriter(object):
+    """ Marshals an XML-RPC `methodResponse` straight to the response,
+    normalizing and converting output on the way:
+     1. None => ''
+     2. datetime => xmlrpclib.DateTime
+     3. Binary => base64, encoded from its file in chunks
+     4. genshi.builder.Fragment|genshi.core.Markup => unicode
+
+    Text is sanitized and encoded to UTF-8 per chunk by a `ResponseStream`.
+    """
+
+    def __init__(self, req, content_type, chunk_size=WRITE_CHUNK_SIZE):
+        self._stream = ResponseStream(req, content_type, chunk_size,
+                                      _sanitize)
+        self._write = self._stream.write
+        self._memo = {}
+
+    started = property(lambda self: self._stream.started,
+                       doc="`True` once anything was sent.")
+
+    def send(self, result):
+        """ Write the response for `result`, and finish the request. """
+        self._write(u"<?xml version='1.0'?>\n<methodResponse>\n<params>\n"
+                    u"<param>\n")
+        self._dump(result)
+        self._write(u"</param>\n</params>\n</methodResponse>\n")
+        self._stream.close()
+
+    # Internal methods
+
+    def _dump(self, value):
+        write = self._write
+        if value is None or value is empty:
+            write(u'<value><string></string></value>\n')
+        elif isinstance(value, (genshi.builder.Fragment, genshi.core.Markup)) \
+                or babel and isinstance(value, babel.support.LazyProxy):
+            self._dump(to_unicode(value))
+        elif isinstance(value, bool):
+            write(u'<value><boolean>%d</boolean></value>\n' % value)
+        elif isinstance(value, (int, long)):
+            if value > xmlrpclib.MAXINT or value < xmlrpclib.MININT:
+                raise OverflowError("int exceeds XML-RPC limits")
+            write(u'<value><int>%d</int></value>\n' % value)
+        elif isinstance(value, float):
+            write(u'<value><double>%r</double></value>\n' % value)
+        elif isinstance(value, basestring):
+            write(u'<value><string>%s</string></value>\n'
+                  % _escape(to_unicode(value)))
+        elif isinstance(value, datetime.datetime):
+            self._dump(to_xmlrpc_datetime(value))
+        elif isinstance(value, xmlrpclib.DateTime):
+            write(u'<value><dateTime.iso8601>%s</dateTime.iso8601></value>\n'
+                  % value.value)
+        elif isinstance(value, xmlrpclib.Binary):
+            self._dump_binary(value)
+        elif isinstance(value, (list, tuple)):
+            self._enter(value)
+            write(u'<value><array><data>\n')
+            for item in value:
+                self._dump(item)
+            write(u'</data></array></value>\n')
+            self._leave(value)
+        elif isinstance(value, dict):
+            self._dump_struct(value)
+        elif hasattr(value, '__dict__'):
+            # Instances are marshalled as a struct of their attributes
+            self._dump_struct(value.__dict__)
+        else:
+            raise TypeError("cannot marshal %s objects" % type(value))
+
+    def _dump_struct(self, value):
+        write = self._write
+        self._enter(value)
+        write(u'<value><struct>\n')
+        for key, item in value.iteritems():
+            if not isinstance(key, basestring):
+                raise TypeError("dictionary key must be string")
+            write(u'<member>\n<name>%s</name>\n' % _escape(to_unicode(key)))
+            self._dump(item)
+            write(u'</member>\n')
+        write(u'</struct></value>\n')
+        self._leave(value)
+
+    def _dump_binary(self, value):
+        if isinstance(value, Binary):
+            fileobj = value.open()
+        else:
+            fileobj = StringIO(value.data)
+        self._write(u'<value><base64>\n')
+        while True:
+            # Multiple of 57 bytes, the size of a base64 line
+            data = fileobj.read(57 * 1024)
+            if not data:
+                break
+            self._write(unicode(base64.encodestring(data)))
+        self._write(u'</base64></value>\n')
+
+    def _enter(self, value):
+        if id(value) in self._memo:
+            raise TypeError("cannot marshal recursive %s"
+                            % type(value).__name__)
+        self._memo[id(value)] = None
+
+    def _leave(self, value):
+        del self._memo[id(value)]
+
+def _sanitize(text):
+    return _illegal_xml_chars_RE.sub(REPLACEMENT_CHAR, text)
+
+def _escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+               .replace(u'>', u'&gt;')
+
+def _stringify(text):
+    """ Return ASCII-only text as `str`, like `xmlrpclib` does. """
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        return text
+
 class XmlRpcProtocol(Component):
     r"""
     There should be XML-RPC client implementations available for all
@@ -111,31 +351,52 @@ class XmlRpcProtocol(Component):
     def parse_rpc_request(self, req, content_type):
         """ Parse XML-RPC requests."""
         try:
-            request = req.read(int(req.get_header('Content-Length')))
-            self.log.debug("RPC(xml) request: %s" % (repr(request)))
-            args, method = xmlrpclib.loads(request)
+            body = RequestBody(req, READ_CHUNK_SIZE)
+            parser = RequestParser()
+            first = True
+            while True:
+                chunk = body.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if first:
+                    self._log_payload("RPC(xml) request: %s", chunk)
+                    first = False
+                parser.feed(chunk)
+            method, args = parser.close()
+        except HTTPRequestEntityTooLarge:
+            raise
         except Exception, e:
             self.log.debug("RPC(xml) parse error: %s", to_unicode(e))
+            self._count('parse_errors')
             raise ProtocolException(xmlrpclib.Fault(-32700, to_unicode(e)))
         else :
-            self.log.debug("RPC(xml) call by '%s', method '%s' with args: %s" \
-                                        % (req.authname, method, repr(args)))
-            args = self._normalize_xml_input(args)
+            self._count(method in MULTICALL_METHODS and 'multicalls'
+                        or 'requests')
+            self._log_payload("RPC(xml) call by '%s', method '%s' with "
+                              "args: %s", req.authname, method, args)
             return {'method' : method, 'params' : args}
 
     def send_rpc_result(self, req, result):
         """Send the result of the XML-RPC call back to the client."""
         rpcreq = req.rpc
         method = rpcreq.get('method')
-        self.log.debug("RPC(xml) '%s' result: %s" % (
-                                                    method, repr(result)))
-        result = tuple(self._normalize_xml_output([result]))
-        self._send_response(req,
-                xmlrpclib.dumps(result, methodresponse=True), rpcreq['mimetype'])
+        self._count('results')
+        self._log_payload("RPC(xml) '%s' result: %s", method, result)
+        writer = ResponseWriter(req, rpcreq['mimetype'])
+        try:
+            writer.send(result)
+        except Exception, e:
+            if not writer.started:
+                raise
+            # Too late to send a fault, the client gets a truncated response
+            self.log.error("RPC(xml) '%s' result could not be sent: %s",
+                           method, to_unicode(e))
+        raise RequestDone
 
     def send_rpc_error(self, req, e):
         """Send an XML-RPC fault message back to the caller"""
         rpcreq = req.rpc
+        self._count('faults')
         fault = None
         if isinstance(e, ProtocolException):
             fault = e._exc
@@ -167,76 +428,16 @@ class XmlRpcProtocol(Component):
 
     # Internal methods
 
+    def _count(self, event):
+        RPCMetrics(self.env).count('XML-RPC', event)
+
+    def _log_payload(self, message, *args):
+        log_payload(self.log, XMLRPCSystem(self.env).log_payload_size,
+                    message, *args)
+
     def _send_response(self, req, response, content_type='application/xml'):
-        response = to_unicode(response)
-        response = _illegal_xml_chars_RE.sub(REPLACEMENT_CHAR, response)
-        response = response.encode("utf-8")
-        req.send_response(200)
-        req.send_header('Content-Type', content_type)
-        req.send_header('Content-Length', len(response))
-        req.end_headers()
-        req.write(response)
-        self.log.debug("RPC(xml) response: %s" % (repr(response)))
+        stream = ResponseStream(req, content_type, sanitize=_sanitize)
+        stream.write(to_unicode(response))
+        stream.close()
+        self._log_payload("RPC(xml) response: %s", response)
         raise RequestDone
-
-    def _normalize_xml_input(self, args):
-        """ Normalizes arguments (at any level - traversing dicts and lists):
-        1. xmlrpc.DateTime is converted to Python datetime
-        2. tracrpc.api.Binary => xmlrpclib.Binary
-        2. String line-endings same as from web (`\n` => `\r\n`)
-        """
-        new_args = []
-        for arg in args:
-            # self.env.log.debug("arg %s, type %s" % (arg, type(arg)))
-            if isinstance(arg, basestring):
-                if arg == 'false':
-                    arg = '0'
-                elif arg == 'true':
-                    arg = '1'
-            if isinstance(arg, xmlrpclib.DateTime):
-                new_args.append(from_xmlrpc_datetime(arg))
-            elif isinstance(arg, xmlrpclib.Binary):
-                arg.__class__ = Binary
-                new_args.append(arg)
-            elif isinstance(arg, basestring):
-                new_args.append(arg.replace("\n", "\r\n"))
-            elif isinstance(arg, dict):
-                for key, val in arg.items():
-                    arg[key], = self._normalize_xml_input([val])
-                new_args.append(arg)
-            elif isinstance(arg, (list, tuple)):
-                new_args.append(self._normalize_xml_input(arg))
-            else:
-                new_args.append(arg)
-        return new_args
-
-    def _normalize_xml_output(self, result):
-        """ Normalizes and converts output (traversing it):
-        1. None => ''
-        2. datetime => xmlrpclib.DateTime
-        3. Binary => xmlrpclib.Binary
-        4. genshi.builder.Fragment|genshi.core.Markup => unicode
-        """
-        new_result = []
-        for res in result:
-            if isinstance(res, datetime.datetime):
-                new_result.append(to_xmlrpc_datetime(res))
-            elif isinstance(res, Binary):
-                res.__class__ = xmlrpclib.Binary
-                new_result.append(res)
-            elif res is None or res is empty:
-                new_result.append('')
-            elif isinstance(res, (genshi.builder.Fragment, \
-                                  genshi.core.Markup)):
-                new_result.append(to_unicode(res))
-            elif babel and isinstance(res, babel.support.LazyProxy):
-                new_result.append(to_unicode(res))
-            elif isinstance(res, dict):
-                for key, val in res.items():
-                    res[key], = self._normalize_xml_output([val])
-                new_result.append(res)
-            elif isinstance(res, list) or isinstance(res, tuple):
-                new_result.append(self._normalize_xml_output(res))
-            else:
-                new_result.append(res)
-        return new_result